@@ -0,0 +1,156 @@
+# build_index.py
+import mmap
+import os
+import pickle
+import re
+
+import orjson
+
+GENERATED_DATA_FILE = 'data/generated/bg3_wiki_data_keywords.jsonl'
+INDEX_FILE = 'data/generated/bg3_wiki_index.pkl'
+# Word tokens as seen by \b boundaries; KeyBERT keywords are always single \w+ tokens,
+# so a keyword matches a title as a whole word exactly when it is one of these tokens
+TITLE_TOKEN_PATTERN = re.compile(r'\w+')
+# A line's top-level "url" string, both writers put it first. Escaped values are left to a full parse.
+URL_FIELD_PATTERN = re.compile(rb'"url"\s*:\s*"([^"\\]*)"')
+# Bumped whenever the index layout changes, so older pickles are rebuilt
+INDEX_VERSION = 3
+
+
+def get_source_signature(filepath):
+    """Returns (size, mtime_ns) of filepath, used to detect a stale index."""
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def normalize_doc_keywords(keywords):
+    """
+    Returns a doc's keywords as a tuple of (keyword, float weight) tuples, dropping malformed
+    entries and reading unparsable weights as 0.0. Indexed docs store their keywords this way,
+    so consumers need no per-entry checks and the tuple can key caches directly.
+    """
+    if not isinstance(keywords, (list, tuple)):
+        return ()
+    normalized = []
+    for kw_entry in keywords:
+        if isinstance(kw_entry, (list, tuple)) and len(kw_entry) == 2 and isinstance(kw_entry[0], str):
+            try:
+                weight = float(kw_entry[1])
+            except (ValueError, TypeError):
+                weight = 0.0
+            normalized.append((kw_entry[0], weight))
+    return tuple(normalized)
+
+
+def get_jsonl_line_url(line):
+    """
+    Returns the 'url' of a raw JSONL line (None when it has none), matched with URL_FIELD_PATTERN
+    so the rest of the line, which holds the whole page text, is never parsed. Falls back to
+    orjson, which raises orjson.JSONDecodeError for malformed lines, when the pattern misses.
+    """
+    match = URL_FIELD_PATTERN.search(line)
+    if match:
+        return match.group(1).decode('utf-8')
+    entry = orjson.loads(line)
+    return entry.get('url') if isinstance(entry, dict) else None
+
+
+def iter_jsonl_lines(filepath):
+    """
+    Yields the raw bytes of each line in filepath through a read-only mmap,
+    so repeated builds are served from the OS page cache without extra copies.
+    """
+    with open(filepath, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b'')
+
+
+def build_index(data_filepath=GENERATED_DATA_FILE):
+    """
+    Reads the generated keyword JSONL once and builds an inverted index over it.
+    Returns a dict with:
+      'docs': list of document dicts, the list position is the doc id
+      'kw2docs': {keyword_lower: {doc_id: max keyword weight}}
+      'title_tokens2docs': {title_token_lower: set of doc ids}
+      'source_signature': signature of data_filepath the index was built from
+      'version': INDEX_VERSION
+    Each doc's 'keywords' are replaced by their normalize_doc_keywords form.
+    """
+    docs = []
+    kw2docs = {}
+    title_tokens2docs = {}
+
+    for line_number, line in enumerate(iter_jsonl_lines(data_filepath), 1):
+        try:
+            doc = orjson.loads(line)  # orjson tolerates the trailing newline
+        except orjson.JSONDecodeError:
+            print(f"Warning: Could not parse line {line_number} in {data_filepath}. Skipping.")
+            continue
+
+        doc_id = len(docs)
+        doc['keywords'] = normalize_doc_keywords(doc.get('keywords', []))
+        docs.append(doc)
+
+        for token in TITLE_TOKEN_PATTERN.findall((doc.get('title') or '').lower()):
+            title_tokens2docs.setdefault(token, set()).add(doc_id)
+
+        for doc_kw, doc_kw_weight in doc['keywords']:
+            postings = kw2docs.setdefault(doc_kw.lower(), {})
+            # Matches are ranked by their best keyword weight, never below 0.0
+            postings[doc_id] = max(postings.get(doc_id, 0.0), doc_kw_weight)
+
+    return {
+        'docs': docs,
+        'kw2docs': kw2docs,
+        'title_tokens2docs': title_tokens2docs,
+        'source_signature': get_source_signature(data_filepath),
+        'version': INDEX_VERSION,
+    }
+
+
+def save_index(index, index_filepath=INDEX_FILE):
+    """Pickles the index to index_filepath."""
+    os.makedirs(os.path.dirname(index_filepath), exist_ok=True)
+    with open(index_filepath, 'wb') as outfile:
+        pickle.dump(index, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_index(data_filepath=GENERATED_DATA_FILE, index_filepath=INDEX_FILE):
+    """
+    Loads the pickled index, rebuilding (and re-saving) it when it is missing
+    or was built from a different version of data_filepath.
+    """
+    if os.path.exists(index_filepath):
+        try:
+            with open(index_filepath, 'rb') as infile:
+                index = pickle.load(infile)
+            if index.get('version') != INDEX_VERSION:
+                print(f"Index {index_filepath} was built by an older version. Rebuilding...")
+            elif index.get('source_signature') == get_source_signature(data_filepath):
+                return index
+            else:
+                print(f"Index {index_filepath} is out of date with {data_filepath}. Rebuilding...")
+        except (pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"Warning: Could not load index {index_filepath}: {e}. Rebuilding...")
+
+    index = build_index(data_filepath)
+    try:
+        save_index(index, index_filepath)
+    except OSError as e:
+        print(f"Warning: Could not save index to {index_filepath}: {e}")
+    return index
+
+
+if __name__ == "__main__":
+    if not os.path.exists(GENERATED_DATA_FILE):
+        print(f"Preprocessed data file {GENERATED_DATA_FILE} not found.")
+        print("Please run `python preprocess_keywords_from_wikis.py` first.")
+    else:
+        print(f"Building search index from {GENERATED_DATA_FILE}...")
+        index = build_index()
+        save_index(index)
+        print(f"Indexed {len(index['docs'])} documents, {len(index['kw2docs'])} keywords "
+              f"and {len(index['title_tokens2docs'])} title tokens.")
+        print(f"Index saved to {INDEX_FILE}")
\ No newline at end of file
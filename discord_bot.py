@@ -4,25 +4,60 @@ from discord.ext import commands
 import google.generativeai as genai
 import os
 import asyncio
+import threading
 import argparse
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Import the core RAG processing logic
 from gemini_bg3_rag import (
-    process_query_with_rag_chat,
+    SAFETY_SETTINGS,
+    stream_query_with_rag_chat,
+    warm_up,
     DEFAULT_KNOWLEDGE_BASE_TOPIC  # Or import specific constants if needed
 )
+from keyword_extractor import embed_text  # Same MiniLM model the keyword search already loads
+from semantic_cache import SemanticCache
 
 # --- Discord Bot Configuration ---
 DISCORD_TOKEN_ENV = "DISCORD_BOT_TOKEN"
 GEMINI_API_KEY_ENV = "GEMINI_API_KEY"
 DEFAULT_GEMINI_MODEL_ENV = "DEFAULT_GEMINI_MODEL"
 DEFAULT_MODEL_NAME = "gemini-2.0-flash"
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95  # Cosine similarity for a query to reuse a previous answer
+ANSWER_CACHE_TTL_SECONDS = 3600
+MAX_CONCURRENT_RAG_QUERIES = 8
+DISCORD_MESSAGE_CHUNK_SIZE = 1950  # Discord caps messages at 2000 characters
+STREAM_EDIT_INTERVAL_SECONDS = 1.0  # Discord rate limits message edits, so batch streamed text
+MAX_CHAT_SESSIONS = 1000
+CHAT_STATE_DIR = "chat_state"  # One <user_id>.jsonl of history Contents per user, with --persist-chat-history
+CHAT_SESSION_IDLE_TTL_SECONDS = 3600  # A session unused this long is dropped, like a !newchat
+
+
+class ChatSessionCache(TTLCache):
+    """
+    Holds at most maxsize chat sessions, dropping the least recently used one when full and any
+    session idle for ttl seconds. Each lookup refreshes the session's TTL.
+    The RAG core keeps each session's history bounded by summarizing its older messages.
+    """
+
+    def __getitem__(self, user_id):
+        chat_session = super().__getitem__(user_id)
+        self[user_id] = chat_session  # Re-inserting restarts the idle TTL
+        return chat_session
 
 # --- Global Variables for the Bot ---
-user_chat_sessions = {}  # {user_id: genai.ChatSession}
+user_chat_sessions = ChatSessionCache(maxsize=MAX_CHAT_SESSIONS, ttl=CHAT_SESSION_IDLE_TTL_SECONDS)  # {user_id: genai.ChatSession}
+# Answers to questions asked without chat history, keyed by query embedding and shared by all users.
+# Follow-ups like "what about his class?" depend on the conversation, so they always run RAG.
+answer_cache = SemanticCache(threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS)
+user_query_queues = {}  # {user_id: asyncio.Queue of (ctx, query)}, present while that user has queries pending
+rag_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RAG_QUERIES)  # Bounds worker threads & concurrent Gemini calls
+background_tasks = set()
 gemini_model_instance = None
 bot_cli_verbose = False  # For CLI logging of bot actions, not RAG core
+persist_chat_history = False  # Keep chat histories across restarts
+chat_state_lock = asyncio.Lock()  # Serializes saving and deleting chat history files
 
 # --- Discord Bot Setup ---
 intents = discord.Intents.default()
@@ -41,13 +76,7 @@ async def initialize_gemini_model():
     model_name = os.environ.get(DEFAULT_GEMINI_MODEL_ENV, DEFAULT_MODEL_NAME)
     try:
         genai.configure(api_key=api_key)
-        safety_settings_config = [
-            {"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in [
-                "HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH",
-                "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"
-            ]
-        ]
-        gemini_model_instance = genai.GenerativeModel(model_name, safety_settings=safety_settings_config)
+        gemini_model_instance = genai.GenerativeModel(model_name, safety_settings=SAFETY_SETTINGS)
         print(f"Gemini model '{model_name}' initialized successfully for the bot.")
         return True
     except Exception as e:
@@ -57,70 +86,256 @@ async def initialize_gemini_model():
 
 @bot.event
 async def on_ready():
-    global bot_cli_verbose
+    global bot_cli_verbose, persist_chat_history
     # Command-line arguments for the bot script itself
     parser = argparse.ArgumentParser(description="Discord Bot with Gemini RAG Core")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose CLI logging for bot operations.")
+    parser.add_argument("--persist-chat-history", action="store_true",
+                        help=f"Save each user's chat history to {CHAT_STATE_DIR}/ and restore it after a restart.")
     args, _ = parser.parse_known_args()
     bot_cli_verbose = args.verbose
+    persist_chat_history = args.persist_chat_history
     if bot_cli_verbose:
         print("Discord Bot: CLI verbose logging enabled.")
+    if persist_chat_history:
+        print(f"Discord Bot: Chat histories are persisted to {CHAT_STATE_DIR}/")
 
     if not await initialize_gemini_model():
         print("Bot cannot start due to Gemini model initialization failure. Check API key and configuration.")
         await bot.close()  # Stop the bot
         return
 
+    # Load the search index & embedding model in the background so the first !ask doesn't pay for it
+    warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up, bot_cli_verbose))
+    background_tasks.add(warm_up_task)
+    warm_up_task.add_done_callback(background_tasks.discard)
+
     print(f"🤖 {bot.user} (BG3 Bot Hopewell) is online!")
     print(f"Knowledge Base Topic: {DEFAULT_KNOWLEDGE_BASE_TOPIC}")  # Using the default from core
     print(
         f"Use !ask <query> to interact. Verbose RAG logging is controlled by gemini_rag_core's verbose flag (passed from here).")
 
 
-@bot.command(name="ask")
-async def ask(ctx: commands.Context, *, query: str):
-    if not gemini_model_instance:
-        await ctx.send("⚠️ The AI model isn't ready. Please tell the admin to check the bot console.")
-        return
+def get_chat_state_path(user_id: int) -> str:
+    return os.path.join(CHAT_STATE_DIR, f"{user_id}.jsonl")
+
+
+def load_chat_history(user_id: int) -> list:
+    """Returns the user's saved chat history as Content protos, or [] if there is none."""
+    try:
+        with open(get_chat_state_path(user_id), 'r', encoding='utf-8') as infile:
+            return [genai.protos.Content.from_json(line) for line in infile if line.strip()]
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"Warning: Could not load saved chat history for user {user_id}, starting fresh: {e}")
+        return []
+
+
+def save_chat_history(user_id: int, history: list):
+    """
+    Writes the user's chat history, one Content per line. The file is replaced rather than
+    appended to since the RAG core rewrites older history into a summary.
+    """
+    os.makedirs(CHAT_STATE_DIR, exist_ok=True)
+    path = get_chat_state_path(user_id)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as outfile:
+        outfile.writelines(f"{genai.protos.Content.to_json(content, indent=None)}\n" for content in history)
+    os.replace(temp_path, path)  # A crash mid-write never leaves a truncated history
+
+
+def delete_chat_history(user_id: int) -> bool:
+    """Deletes the user's saved chat history, returns whether there was one."""
+    try:
+        os.remove(get_chat_state_path(user_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+async def send_answer(ctx: commands.Context, response_text: str):
+    """Sends an answer, splitting it into parts that fit Discord's message limit."""
+    if len(response_text) > DISCORD_MESSAGE_CHUNK_SIZE:
+        await ctx.send(f"🧠 **{bot.user.name} says:**\nThe answer is long, sending in parts:")
+        for i in range(0, len(response_text), DISCORD_MESSAGE_CHUNK_SIZE):
+            await ctx.send(response_text[i:i + DISCORD_MESSAGE_CHUNK_SIZE])
+    else:
+        await ctx.send(f"🧠 **{bot.user.name} says:**\n{response_text}")
+
+
+async def iter_in_thread(func, *args):
+    """
+    Runs the blocking generator func(*args) in a worker thread, yielding its items on the event loop.
+    Closing this generator early stops and closes func's generator too, after its current item.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    end_of_stream = object()
+    stop_producing = threading.Event()
+
+    def produce():
+        try:
+            generator = func(*args)
+            try:
+                for item in generator:
+                    if stop_producing.is_set():
+                        break
+                    loop.call_soon_threadsafe(items.put_nowait, item)
+            finally:
+                generator.close()  # Runs its cleanup, e.g. dropping a half-streamed turn from the chat history
+        finally:
+            loop.call_soon_threadsafe(items.put_nowait, end_of_stream)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(produce))
+    try:
+        while (item := await items.get()) is not end_of_stream:
+            yield item
+    finally:
+        stop_producing.set()  # Only has an effect when the consumer stopped early
+        await producer  # Waits for the thread to finish, re-raises anything the generator raised
 
+
+async def send_streamed_answer(ctx: commands.Context, text_chunks) -> str:
+    """
+    Sends an answer while it is still being generated, editing the message in place as text
+    arrives and continuing in a new message once it would exceed Discord's limit.
+    Returns the full answer text.
+    """
+    loop = asyncio.get_running_loop()
+    prefix = f"🧠 **{bot.user.name} says:**\n"
+    received = []
+    message, message_text, shown_text = None, "", ""
+    last_edit = 0.0
+    try:
+        async for chunk in text_chunks:
+            received.append(chunk)
+            message_text += chunk
+            while len(message_text) > DISCORD_MESSAGE_CHUNK_SIZE:
+                # Finish the current message and carry the overflow into the next one
+                full_part, message_text = message_text[:DISCORD_MESSAGE_CHUNK_SIZE], message_text[DISCORD_MESSAGE_CHUNK_SIZE:]
+                if message is None:
+                    await ctx.send(prefix + full_part)
+                else:
+                    await message.edit(content=prefix + full_part)
+                message, shown_text, prefix = None, "", ""
+            if not message_text:
+                continue
+            if message is None:
+                message = await ctx.send(prefix + message_text)
+                shown_text, last_edit = message_text, loop.time()
+            elif loop.time() - last_edit >= STREAM_EDIT_INTERVAL_SECONDS:
+                await message.edit(content=prefix + message_text)
+                shown_text, last_edit = message_text, loop.time()
+        if message is not None and shown_text != message_text:
+            await message.edit(content=prefix + message_text)
+    finally:
+        await text_chunks.aclose()  # Stops generating the rest of the answer if a send or edit failed
+    return "".join(received)
+
+
+async def answer_query(ctx: commands.Context, query: str):
+    """Answers one !ask query. Queries from the same user are run one at a time, in order."""
     user_id = ctx.author.id
     # Get or create chat session for the user
     if user_id not in user_chat_sessions:
         if bot_cli_verbose: print(f"Bot Verbose: Creating new chat session for user {user_id}")
-        user_chat_sessions[user_id] = gemini_model_instance.start_chat(history=[])
+        saved_history = await asyncio.to_thread(load_chat_history, user_id) if persist_chat_history else []
+        if saved_history and bot_cli_verbose:
+            print(f"Bot Verbose: Restored {len(saved_history)} saved messages for user {user_id}")
+        user_chat_sessions[user_id] = gemini_model_instance.start_chat(history=saved_history)
 
     current_chat_session = user_chat_sessions[user_id]
 
     await ctx.send("🔍 Thinking...")
     try:
-        # Run the synchronous RAG processing in a separate thread
-        # Pass the bot's verbose flag to the RAG core's verbose flag
-        response_text = await asyncio.to_thread(
-            process_query_with_rag_chat,
-            query,
-            current_chat_session,  # Pass the specific user's session
-            gemini_model_instance,
-            DEFAULT_KNOWLEDGE_BASE_TOPIC,  # Can be made dynamic if needed
-            bot_cli_verbose  # RAG core will use this for its own verbose prints
-        )
-
-        if len(response_text) > 1950:
-            await ctx.send(f"🧠 **{bot.user.name} says:**\nThe answer is long, sending in parts:")
-            for i in range(0, len(response_text), 1950):
-                await ctx.send(response_text[i:i + 1950])
+        query_embedding = await asyncio.to_thread(embed_text, query)
+        is_cacheable = not current_chat_session.history
+        cached_answer = answer_cache.get(query_embedding) if is_cacheable else None
+        history_length_before = len(current_chat_session.history)
+        if cached_answer is not None:
+            if bot_cli_verbose: print(f"Bot Verbose: Semantic cache hit for user {user_id}, skipping RAG.")
+            await send_answer(ctx, cached_answer)
+            # Recorded like an answered turn, so the user's follow-ups are asked with this history
+            current_chat_session.history.extend([
+                genai.protos.Content(role="user", parts=[genai.protos.Part(text=query)]),
+                genai.protos.Content(role="model", parts=[genai.protos.Part(text=cached_answer)]),
+            ])
         else:
-            await ctx.send(f"🧠 **{bot.user.name} says:**\n{response_text}")
+            # Run the synchronous RAG processing in a separate thread, at most MAX_CONCURRENT_RAG_QUERIES at once,
+            # and stream the answer to Discord as Gemini generates it
+            # Pass the bot's verbose flag to the RAG core's verbose flag
+            async with rag_semaphore:
+                response_text = await send_streamed_answer(ctx, iter_in_thread(
+                    stream_query_with_rag_chat,
+                    query,
+                    current_chat_session,  # Pass the specific user's session
+                    gemini_model_instance,
+                    DEFAULT_KNOWLEDGE_BASE_TOPIC,  # Can be made dynamic if needed
+                    bot_cli_verbose,  # RAG core will use this for its own verbose prints
+                    query_embedding  # Reused for the RAG core's retrieval cache
+                ))
+
+        # A !newchat while this answer was sent dropped the session, so its answer and history are left out
+        if user_chat_sessions.get(user_id) is not current_chat_session:
+            return
+        # The chat history only grows when Gemini fully answered, so errors, blocked and cut-off replies aren't cached
+        if cached_answer is None and is_cacheable and len(current_chat_session.history) > history_length_before:
+            answer_cache.set(query_embedding, response_text)
+        if persist_chat_history:
+            async with chat_state_lock:
+                # Checked again under the lock, a !newchat may have dropped the session while waiting for it
+                if user_chat_sessions.get(user_id) is current_chat_session:
+                    await asyncio.to_thread(save_chat_history, user_id, list(current_chat_session.history))
 
     except Exception as e:
         print(f"Error in !ask command for user {user_id}: {e}")  # Log full error to console
         await ctx.send(f"⚠️ An unexpected error occurred. Please try again or contact an admin.")
 
 
+async def drain_user_queries(user_id: int, queue: asyncio.Queue):
+    """Processes a user's queued queries in order, then exits once their queue is empty."""
+    while True:
+        ctx, query = await queue.get()
+        try:
+            await answer_query(ctx, query)
+        finally:
+            queue.task_done()
+        if queue.empty():
+            # No await between the check and the removal, so no query can slip in unprocessed
+            del user_query_queues[user_id]
+            return
+
+
+@bot.command(name="ask")
+async def ask(ctx: commands.Context, *, query: str):
+    if not gemini_model_instance:
+        await ctx.send("⚠️ The AI model isn't ready. Please tell the admin to check the bot console.")
+        return
+
+    user_id = ctx.author.id
+    queue = user_query_queues.get(user_id)
+    if queue is None:
+        queue = user_query_queues[user_id] = asyncio.Queue()
+        worker = asyncio.create_task(drain_user_queries(user_id, queue))
+        background_tasks.add(worker)  # The event loop only keeps weak references to tasks
+        worker.add_done_callback(background_tasks.discard)
+    elif bot_cli_verbose:
+        print(f"Bot Verbose: Queued query for user {user_id} behind {queue.qsize()} pending query(s)")
+    queue.put_nowait((ctx, query))
+
+
 @bot.command(name="newchat", aliases=["new", "reset"])
 async def new_chat_command(ctx: commands.Context):  # Renamed to avoid conflict with any 'new' keyword
     user_id = ctx.author.id
-    if user_id in user_chat_sessions:
-        del user_chat_sessions[user_id]  # This removes the session, a new one will be made on next !ask
+    # Removed before any await, so an answer still streaming for the old session won't save it afterwards.
+    # A new session will be made on the next !ask.
+    had_session = user_chat_sessions.pop(user_id, None) is not None
+    had_saved_history = False
+    if persist_chat_history:
+        async with chat_state_lock:
+            had_saved_history = await asyncio.to_thread(delete_chat_history, user_id)
+    if had_session or had_saved_history:
         await ctx.send(f"✨ Your conversation history with {bot.user.name} has been reset!")
         if bot_cli_verbose: print(f"Bot Verbose: Chat session reset for user {user_id}")
     else:
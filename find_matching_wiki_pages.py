@@ -1,12 +1,16 @@
 # search_data.py
-import json
+import functools
+import hashlib
 import os
-import re
+import threading
 
-from keyword_extractor import extract_keywords
+import diskcache
+
+from build_index import INDEX_VERSION, load_index
+from keyword_extractor import extract_keywords, get_embedding_model_id
 
 GENERATED_DATA_FILE = 'data/generated/bg3_wiki_data_keywords.jsonl'
-SEARCH_QUERY_BLACKLIST = {
+SEARCH_QUERY_BLACKLIST = frozenset({
     "a", "an", "the", "is", "are", "was", "were", "be", "been", "being",
     "have", "has", "had", "do", "does", "did", "will", "would", "should",
     "can", "could", "may", "might", "must", "am",
@@ -28,19 +32,75 @@ SEARCH_QUERY_BLACKLIST = {
     "use"  # Added 'use' as per your example
     # Add other words like 'page', 'article', 'information', 'about', 'help'
     # if they are too generic for your search context.
-}
+})
 MIN_USER_KEYWORD_LENGTH = 2
+SEARCH_CACHE_SIZE = 1024  # Distinct keyword sets whose results are kept in memory
+# Results per query, kept across restarts and shared by every process using the same directory
+SEARCH_DISK_CACHE_DIR = 'data/cache/search'
+SEARCH_DISK_CACHE_TTL_SECONDS = 86400
+
+_search_index = None  # Inverted index from build_index.py, loaded on first search
+_search_index_lock = threading.Lock()
+_search_disk_cache = None
+_search_disk_cache_lock = threading.Lock()
+
+
+def get_index() -> dict:
+    """
+    Returns the inverted search index, loading it on first use.
+    The index is cached for the lifetime of the process.
+    """
+    global _search_index
+    if _search_index is None:
+        with _search_index_lock:
+            if _search_index is None:
+                _search_index = load_index(GENERATED_DATA_FILE)
+    return _search_index
+
+
+def get_search_disk_cache() -> diskcache.Cache:
+    """Returns the on-disk cache of search results, opening it on first use."""
+    global _search_disk_cache
+    if _search_disk_cache is None:
+        with _search_disk_cache_lock:
+            if _search_disk_cache is None:
+                _search_disk_cache = diskcache.Cache(SEARCH_DISK_CACHE_DIR)
+    return _search_disk_cache
+
+
+def get_search_cache_key(user_query: str, source_signature) -> str:
+    """
+    Keys a query by its case- and whitespace-normalized text, the version of the data it was
+    searched in, the index format and the KeyBERT model that extracted the query's keywords,
+    so results are never served from an outdated index or another model's keywords.
+    """
+    normalized_query = " ".join(user_query.lower().split())
+    return hashlib.sha1(f"{source_signature}\n{INDEX_VERSION}\n{get_embedding_model_id()}\n{normalized_query}"
+                        .encode()).hexdigest()
 
 
 def search_documents(user_query: str) -> list[dict]:
-    # ... (this function's content remains exactly the same as your last version)
-    # It already returns a list of full document dictionaries: [item[2] for item in sorted_matches]
-    # where item[2] is the 'doc' object.
     if not os.path.exists(GENERATED_DATA_FILE):
         print(f"Error: Preprocessed data file {GENERATED_DATA_FILE} not found.")
         print("Please run the preprocess_data.py script first.")
         return []
 
+    index = get_index()
+    search_disk_cache = get_search_disk_cache()
+    cache_key = get_search_cache_key(user_query, index['source_signature'])
+    # Doc ids rather than documents, the documents themselves are already in the index
+    matching_doc_ids = search_disk_cache.get(cache_key)
+    if matching_doc_ids is None:
+        matching_doc_ids = _find_matching_doc_ids(user_query)
+        search_disk_cache.set(cache_key, matching_doc_ids, expire=SEARCH_DISK_CACHE_TTL_SECONDS)
+    else:
+        print(f"Using cached search results for query: '{user_query}'")
+    docs = index['docs']
+    return [docs[doc_id] for doc_id in matching_doc_ids]  # Full document dicts
+
+
+def _find_matching_doc_ids(user_query: str) -> tuple[int, ...]:
+    """Extracts keywords from user_query and returns the ids of the matching documents, best first."""
     user_query_keywords_with_weights = extract_keywords(user_query)
 
     print(f"Keywords initially extracted from user query (by extract_keywords): {user_query_keywords_with_weights}")
@@ -48,72 +108,48 @@ def search_documents(user_query: str) -> list[dict]:
     if not user_query_keywords_with_weights:
         print(
             "Since no keywords were effectively extracted (or extract_keywords returned an empty list), cannot proceed with search.")
-        return []
+        return ()
 
-    processed_user_keyword_strings = []
-    for item in user_query_keywords_with_weights:
-        if isinstance(item, (list, tuple)) and len(item) > 0 and isinstance(item[0], str):
-            keyword_str_lower = item[0].lower()
-            if keyword_str_lower not in SEARCH_QUERY_BLACKLIST and len(keyword_str_lower) >= MIN_USER_KEYWORD_LENGTH:
-                processed_user_keyword_strings.append(keyword_str_lower)
-
-    user_keywords_set_lower = set(processed_user_keyword_strings)
+    user_keywords_set_lower = {
+        keyword_str_lower
+        for item in user_query_keywords_with_weights
+        if isinstance(item, (list, tuple)) and item and isinstance(item[0], str)
+        and (keyword_str_lower := item[0].lower()) not in SEARCH_QUERY_BLACKLIST
+        and len(keyword_str_lower) >= MIN_USER_KEYWORD_LENGTH
+    }
 
     if not user_keywords_set_lower:
         print("No valid (non-blacklisted, sufficient length) keywords remain after filtering user query.")
-        return []
+        return ()
 
     print(f"Searching for user keyword strings (filtered, lowercase): {user_keywords_set_lower}")
 
-    potential_matches = []
-
-    try:
-        with open(GENERATED_DATA_FILE, 'r', encoding='utf-8') as infile:
-            for line_number, line in enumerate(infile, 1):
-                try:
-                    doc = json.loads(line.strip())
-                    title_lower = doc.get('title', '').lower()
-                    doc_keywords_with_weights = doc.get('keywords', [])
-
-                    is_title_match = False
-                    for user_kw_lower_str in user_keywords_set_lower:
-                        pattern = r'\b' + re.escape(user_kw_lower_str) + r'\b'
-                        if re.search(pattern, title_lower):
-                            is_title_match = True
-                            break
-
-                    max_matching_keyword_weight = 0.0
-                    found_keyword_in_list = False
-
-                    if isinstance(doc_keywords_with_weights, list):
-                        for kw_entry in doc_keywords_with_weights:
-                            if isinstance(kw_entry, list) and len(kw_entry) == 2 and isinstance(kw_entry[0], str):
-                                doc_kw_str_lower = kw_entry[0].lower()
-                                try:
-                                    doc_kw_weight = float(kw_entry[1])
-                                except (ValueError, TypeError):
-                                    doc_kw_weight = 0.0
-                                if doc_kw_str_lower in user_keywords_set_lower:
-                                    found_keyword_in_list = True
-                                    max_matching_keyword_weight = max(max_matching_keyword_weight, doc_kw_weight)
-
-                    if is_title_match or found_keyword_in_list:
-                        title_match_priority_score = 1 if is_title_match else 0
-                        effective_weight = max_matching_keyword_weight if found_keyword_in_list else 0.0
-                        potential_matches.append((title_match_priority_score, effective_weight, doc)) # doc is the full document
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not parse line {line_number} in {GENERATED_DATA_FILE}. Skipping.")
-                except (TypeError, ValueError) as e:
-                    print(
-                        f"Warning: Data format error in line {line_number} for keywords: {e}. Entry: {line.strip()[:100]}...")
-                except Exception as e:
-                    print(f"Error processing line {line_number} for search: {e}. Entry: {line.strip()[:100]}...")
-    except FileNotFoundError:
-        print(f"Error: Preprocessed data file {GENERATED_DATA_FILE} not found during search.")
-        return []
-
-    sorted_matches = sorted(potential_matches, key=lambda x: (-x[0], -x[1]))
-    return [item[2] for item in sorted_matches] # Returns a list of full document dicts
+    return _search_cached(frozenset(user_keywords_set_lower))
+
+
+@functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _search_cached(user_keywords_set_lower: frozenset[str]) -> tuple[int, ...]:
+    """
+    Returns the ids of the documents matching an already filtered, lowercased keyword set, best first.
+    Results are cached per keyword set, so rephrasings that extract the same
+    keywords are answered without touching the index again.
+    """
+    index = get_index()
+    kw2docs = index['kw2docs']
+    title_tokens2docs = index['title_tokens2docs']
+
+    # Union of the posting lists, only documents that share a keyword are ever touched
+    title_match_doc_ids = set().union(*(title_tokens2docs.get(kw, ()) for kw in user_keywords_set_lower))
+    max_matching_keyword_weights = {}
+    for user_kw_lower_str in user_keywords_set_lower:
+        for doc_id, doc_kw_weight in kw2docs.get(user_kw_lower_str, {}).items():
+            max_matching_keyword_weights[doc_id] = max(max_matching_keyword_weights.get(doc_id, 0.0), doc_kw_weight)
+
+    candidate_doc_ids = title_match_doc_ids.union(max_matching_keyword_weights)
+    # Title matches first, then by best keyword weight, ties keep file order
+    sorted_doc_ids = sorted(candidate_doc_ids, key=lambda doc_id: (
+        -(doc_id in title_match_doc_ids), -max_matching_keyword_weights.get(doc_id, 0.0), doc_id))
+    return tuple(sorted_doc_ids)
 
 
 if __name__ == "__main__":
@@ -1,124 +1,683 @@
 # gemini_rag_core.py
+import argparse
+import asyncio
+import datetime
+import enum
+import functools
+import hashlib
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator
+
 import google.generativeai as genai
+from dotenv import load_dotenv
+import orjson
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import caching
 import re
-from find_matching_wiki_pages import search_documents  # Ensure this is accessible
+from rank_bm25 import BM25Okapi
+from build_index import normalize_doc_keywords
+from find_matching_wiki_pages import get_index, search_documents  # Ensure this is accessible
+from keyword_extractor import embed_text
+from local_reranker import score_passages
+from semantic_cache import SemanticCache
 
 # --- Constants ---
+SAFETY_SETTINGS = tuple(
+    {"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in [
+        "HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"
+    ]
+)
 MAX_KEYWORDS_PER_PAGE_IN_PROMPT = 7
 MAX_PAGES_FOR_ANSWERING = 3
+# A top local page whose matching keyword weighs at least this is trusted without a re-ranking call
+RERANK_SKIP_KEYWORD_WEIGHT = 0.6
 NUM_HISTORY_TURNS_FOR_GUIDANCE = 4
 # KNOWLEDGE_BASE_TOPIC can be passed to process_query or defined here if static
 # For simplicity, let's assume it's passed if it varies, or static if not.
 DEFAULT_KNOWLEDGE_BASE_TOPIC = "Baldur's Gate 3 game information"
+# Retrieved context is cached server-side (Gemini context caching) so turns, from any user,
+# that retrieve the same pages skip re-prefilling it. Smaller contexts are below the API minimum.
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=5)
+CONTEXT_CACHE_MIN_CHARS = 4 * 4096  # ~4096 tokens
+CONTEXT_CACHE_RETRY_SECONDS = 60  # Pause before creating caches again after a transient API error
+CONTEXT_BLOCK_CACHE_SIZE = 512  # Pages whose passages and BM25 index are kept in memory
+# Longer pages only contribute the passages that best match the query, which bounds the answer prompt
+MAX_CONTEXT_CHARS_PER_PAGE = 6000
+PASSAGE_CHARS = 500
+RETRIEVAL_CACHE_SIMILARITY_THRESHOLD = 0.95  # Cosine similarity for a query to reuse earlier search & re-ranking
+RETRIEVAL_CACHE_TTL_SECONDS = 3600
+SPECULATIVE_GUIDANCE_MAX_WORDS = 6  # Queries this short, with chat history, get their search guidance speculatively
+BACKGROUND_WORKERS = 8  # Threads for speculative guidance calls, history compaction and re-rank shards
+# Stage 2 scores pages with a local cross-encoder, set RERANK_BACKEND=gemini to re-rank with Gemini instead
+RERANK_BACKEND = os.environ.get("RERANK_BACKEND", "cross-encoder").lower()
+# Only the best search hits (in search order) are scored, broad keywords like "bg3" match nearly every page
+RERANK_MAX_CANDIDATES = 100
+# Search results beyond RERANK_SHARD_SIZE pages are re-ranked in concurrent shards
+RERANK_SHARD_SIZE = 40
+RERANK_MAX_SHARDS = 4
+MAX_CONCURRENT_RERANK_CALLS = 8  # Across all queries, keeps shard fan-out within the API rate limit
+# Unsharded re-ranks of queries arriving within RERANK_BATCH_WINDOW_SECONDS share one Gemini call.
+# Latency grows quickly with rows per call, so batches stay small.
+RERANK_BATCH_MAX_SIZE = 8
+RERANK_BATCH_WINDOW_SECONDS = 0.05
+# Chat history beyond MAX_SESSION_MESSAGES is summarized, keeping the newest messages verbatim.
+# Both are even so the history still alternates user and model turns.
+MAX_SESSION_MESSAGES = 30
+SESSION_MESSAGES_KEPT_AFTER_SUMMARY = 16
+
+# Finish reasons of a fully generated answer, anything else means the stream stopped early
+COMPLETE_FINISH_REASONS = (
+    genai.protos.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+    genai.protos.Candidate.FinishReason.STOP,
+    genai.protos.Candidate.FinishReason.MAX_TOKENS,
+)
+
+# Invariant instruction text of each prompt, only the query, results and context vary per turn.
+# Standalone prompts (rerank, guidance) put it first, so requests share a common prefix.
+RERANK_INSTRUCTIONS = ("Task: Re-rank the pages below by relevance to the Original User Query.\n"
+                       "Output: Numbered list of 'Title' and 'URL' for top 10.\n"
+                       "Example:\n1. Title: T1\n   URL: U1")
+ANSWER_INSTRUCTIONS = ("Task: Given ongoing chat & new context, answer current query. Prioritize new context. "
+                       "If info lacking, say so. No external knowledge.")
+CACHED_CONTEXT_ANSWER_INSTRUCTIONS = ("Task: Given ongoing chat & the cached context from the knowledge base, "
+                                      "answer current query. Prioritize that context. If info lacking, say so. "
+                                      "No external knowledge.")
+SEARCH_GUIDANCE_INSTRUCTIONS = ("Based on the query & chat below, suggest an improved search query (2-5 words) for my KB. "
+                                "Output ONLY the query string.\n"
+                                "Example: if user asked 'which one?' after 'Barbarian subclasses', "
+                                "suggest 'Barbarian subclass comparison'.")
+BATCHED_RERANK_INSTRUCTIONS = ("Task: Each QUERY section below holds an Original User Query and its local search results. "
+                               "For every section, re-rank its pages by relevance to its own query only.\n"
+                               "Output: For each section i, the line '=== ANSWER i ===' followed by a numbered "
+                               "list of 'Title' and 'URL' for its top 10.\n"
+                               "Example:\n=== ANSWER 1 ===\n1. Title: T1\n   URL: U1")
+HISTORY_SUMMARY_INSTRUCTIONS = ("Task: Summarize this conversation in under 150 words. Keep the topics, "
+                                "names and facts the user may refer back to. Output ONLY the summary.")
+HISTORY_SUMMARY_PREFIX = "Summary of our earlier conversation: "
+_BM25_TOKEN_RE = re.compile(r"\w+")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+_URL_RE = re.compile(r"^\s*URL:\s*(https?://[^\s]+)", re.MULTILINE | re.IGNORECASE)
+_ANSWER_SECTION_RE = re.compile(r"===\s*ANSWER\s*(\d+)\s*===", re.IGNORECASE)
+
+
+class RagStatus(enum.Enum):
+    """Outcome of the retrieval stages. Only OK means the context holds page text."""
+    OK = "ok"
+    NO_RESULTS = "no_results"
+    BLOCKED = "blocked"
+    PARSE_FAIL = "parse_fail"
+    ERROR = "error"
+
+
+# --- Context Cache State ---
+_context_caches = {}  # {blake2b digest of the context text: caching.CachedContent}
+_context_caches_lock = threading.Lock()
+_context_cache_creations = {}  # {digest: Future resolving to the CachedContent (or None) being created}
+_context_caching_available = True  # Turned off for good when the API refuses caching for this key or model
+_context_caching_retry_at = 0.0  # time.monotonic() before which cache creation is skipped after a transient error
+# (status, context_for_answering, answering_urls) keyed by query embedding, shared by every chat session.
+# Only retrieval is reused here; final answers are cached by the Discord bot alone (answer_cache in discord_bot.py),
+# so the CLI and batch mode always generate a fresh answer.
+_retrieval_cache = SemanticCache(threshold=RETRIEVAL_CACHE_SIMILARITY_THRESHOLD, ttl_seconds=RETRIEVAL_CACHE_TTL_SECONDS)
+_rerank_call_slots = threading.BoundedSemaphore(MAX_CONCURRENT_RERANK_CALLS)
+_background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="rag-background")
 
 
 # --- Helper function to format chat history ---
+def format_message_text(message_content) -> str:
+    """Returns the text parts of a chat history Content joined into one string."""
+    parts = getattr(message_content, 'parts', None)
+    if not parts:
+        return "[empty or non-text parts]"
+    return " ".join(part.text for part in parts if hasattr(part, 'text')).strip()
+
+
 def format_chat_history_snippet(history: list, num_turns: int) -> str:
     if not history:
         return "No prior conversation history."
-    snippet = "Recent Conversation Snippet:\n"
-    relevant_history = history[-num_turns:]
-    for message_content in relevant_history:
-        role = getattr(message_content, 'role', 'unknown').capitalize()
-        text_parts_collected = []
-        if hasattr(message_content, 'parts') and isinstance(message_content.parts, list):
-            for part in message_content.parts:
-                if hasattr(part, 'text'):
-                    text_parts_collected.append(part.text)
-        text = " ".join(text_parts_collected).strip() if text_parts_collected else "[empty or non-text parts]"
-        snippet += f"- {role}: {text}\n"
-    return snippet
+    return "Recent Conversation Snippet:\n" + "".join(
+        f"- {getattr(message_content, 'role', 'unknown').capitalize()}: {format_message_text(message_content)}\n"
+        for message_content in history[-num_turns:])
+
+
+def summarize_chat_history(model: genai.GenerativeModel, history: list) -> str:
+    """Asks Gemini for a short summary of history, returns "" if it didn't produce one."""
+    summary_prompt = f"{format_chat_history_snippet(history, len(history))}\n{HISTORY_SUMMARY_INSTRUCTIONS}"
+    response = model.generate_content(summary_prompt)
+    return response.text.strip() if response.parts else ""
+
+
+def compact_chat_history(chat_session: genai.ChatSession, model: genai.GenerativeModel, verbose: bool = False):
+    """
+    Once chat_session.history exceeds MAX_SESSION_MESSAGES, replaces all but the last
+    SESSION_MESSAGES_KEPT_AFTER_SUMMARY messages with a summary of them, so the history
+    Gemini prefills on every turn stays bounded in long conversations.
+    An earlier summary is part of the replaced messages and gets folded into the new one.
+    """
+    history = chat_session.history
+    if len(history) <= MAX_SESSION_MESSAGES:
+        return
+    older, recent = history[:-SESSION_MESSAGES_KEPT_AFTER_SUMMARY], history[-SESSION_MESSAGES_KEPT_AFTER_SUMMARY:]
+    try:
+        summary = summarize_chat_history(model, older)
+    except Exception as e:
+        if verbose: print(f"CoreRAG Verbose: Error summarizing chat history, dropping {len(older)} old messages: {e}")
+        summary = ""
+    # Contents can only be user or model turns, so the summary goes in as an exchange
+    summary_turn = [{"role": "user", "parts": [f"{HISTORY_SUMMARY_PREFIX}{summary}"]},
+                    {"role": "model", "parts": ["Got it, I'll keep that in mind."]}] if summary else []
+    chat_session.history = [*summary_turn, *recent]
+    if verbose: print(f"CoreRAG Verbose: Compacted chat history from {len(history)} to {len(chat_session.history)} messages.")
 
 
 # --- RAG Pipeline Functions ---
 def format_local_results_for_rerank_prompt(pages: list[dict]) -> str:
     if not pages:
         return "No specific pages found."
-    formatted_string = "Locally found pages:\n\n"
-    for i, page in enumerate(pages, 1):
-        formatted_string += f"{i}. Title: {page.get('title', 'N/A')}\n"
-        formatted_string += f"   URL: {page.get('url', 'N/A')}\n"
-        doc_keywords_with_weights = page.get('keywords', [])
-        if doc_keywords_with_weights:
-            kw_list = []
-            for kw_entry in doc_keywords_with_weights[:MAX_KEYWORDS_PER_PAGE_IN_PROMPT]:
-                if isinstance(kw_entry, (list, tuple)) and len(kw_entry) == 2:
-                    kw_list.append(f"{str(kw_entry[0])} (w: {float(kw_entry[1]):.2f})")
-                elif isinstance(kw_entry, str):
-                    kw_list.append(kw_entry)
-            if kw_list:
-                formatted_string += f"   Keywords: {', '.join(kw_list)}\n"
-        formatted_string += "\n"
-    return formatted_string
+    return "Locally found pages:\n\n" + "".join(
+        f"{i}. {get_rerank_snippet(page)}" for i, page in enumerate(pages, 1))
+
+
+def get_rerank_snippet(page: dict) -> str:
+    """
+    Returns the page's block in the rerank prompt, without its list number. It is rendered on
+    first use and stored on the page as '_rerank_snippet', so every later query the (in-memory,
+    indexed) page shows up in just reuses the string.
+    """
+    snippet = page.get('_rerank_snippet')
+    if snippet is None:
+        keywords = page.get('keywords', ())
+        if not isinstance(keywords, tuple):  # Page didn't come from the search index
+            keywords = normalize_doc_keywords(keywords)
+        snippet = page['_rerank_snippet'] = render_rerank_page(page.get('title', 'N/A'), page.get('url', 'N/A'),
+                                                               keywords)
+    return snippet
+
+
+def render_rerank_page(title: str, url: str, keywords: tuple[tuple[str, float], ...]) -> str:
+    rendered_parts = [f"Title: {title}\n   URL: {url}\n"]
+    if keywords:
+        kw_list = ", ".join(f"{kw} (w: {weight:.2f})" for kw, weight in keywords[:MAX_KEYWORDS_PER_PAGE_IN_PROMPT])
+        rendered_parts.append(f"   Keywords: {kw_list}\n")
+    rendered_parts.append("\n")
+    return "".join(rendered_parts)
 
 
 def construct_rerank_prompt(original_user_query: str, local_search_results_str: str) -> str:
-    return (f"Original User Query: \"{original_user_query}\"\n\n"
-            f"Local search results:\n{local_search_results_str}\n"
-            "Task: Re-rank these pages by relevance to the Original User Query.\n"
-            "Output: Numbered list of 'Title' and 'URL' for top 10.\n"
-            "Example:\n1. Title: T1\n   URL: U1")
+    # Invariant instructions first, so every rerank request starts with the same prefix
+    return (f"{RERANK_INSTRUCTIONS}\n\n"
+            f"Original User Query: \"{original_user_query}\"\n\n"
+            f"Local search results:\n{local_search_results_str}")
 
 
 def parse_reranked_results(gemini_response_text: str) -> list[str]:
-    return re.findall(r"^\s*URL:\s*(https?://[^\s]+)", gemini_response_text, re.MULTILINE | re.IGNORECASE)
+    return _URL_RE.findall(gemini_response_text)
+
+
+def construct_batched_rerank_prompt(queries_with_pages: list[tuple[str, list[dict]]]) -> str:
+    sections = [f"=== QUERY {i} ===\nOriginal User Query: \"{query}\"\n\n"
+                f"Local search results:\n{format_local_results_for_rerank_prompt(pages)}\n"
+                for i, (query, pages) in enumerate(queries_with_pages, 1)]
+    return f"{BATCHED_RERANK_INSTRUCTIONS}\n\n" + "".join(sections)
+
+
+def parse_batched_reranked_results(gemini_response_text: str) -> dict[int, list[str]]:
+    """Splits a batched re-rank response on its '=== ANSWER i ===' lines, returns {i: reranked URLs}."""
+    pieces = _ANSWER_SECTION_RE.split(gemini_response_text)  # [preamble, i, section, i, section, ...]
+    return {int(number): parse_reranked_results(section) for number, section in zip(pieces[1::2], pieces[2::2])}
+
+
+def rerank_shard(model: genai.GenerativeModel, user_query: str, pages: list[dict],
+                 verbose: bool = False) -> tuple[RagStatus, list[str], str]:
+    """
+    Asks Gemini to re-rank pages for user_query.
+    Returns the status, the re-ranked URLs and, when it failed, the context text explaining why.
+    """
+    rerank_context_str = format_local_results_for_rerank_prompt(pages)
+    rerank_prompt = construct_rerank_prompt(user_query, rerank_context_str)  # Use original query
+    if verbose: print(f"CoreRAG Verbose: --- Re-rank Prompt ---\n{rerank_prompt}\n--- End ---")
+    try:
+        with _rerank_call_slots:
+            rerank_response = model.generate_content(rerank_prompt)
+        if rerank_response.prompt_feedback and rerank_response.prompt_feedback.block_reason:
+            if verbose: print(
+                f"CoreRAG Verbose: Re-ranking blocked: {rerank_response.prompt_feedback.block_reason_message or rerank_response.prompt_feedback.block_reason}")
+            return RagStatus.BLOCKED, [], "Re-ranking of local documents was blocked."
+        elif rerank_response.parts:
+            if verbose: print(
+                f"CoreRAG Verbose: --- Gemini's Re-ranked (Raw) ---\n{rerank_response.text}\n--- End ---")
+            reranked_urls = parse_reranked_results(rerank_response.text)
+            if reranked_urls:
+                return RagStatus.OK, reranked_urls, ""
+            return RagStatus.PARSE_FAIL, [], "Re-ranking did not identify relevant pages."
+        return RagStatus.PARSE_FAIL, [], "Re-ranking process yielded no specific pages."
+    except Exception as e:
+        if verbose: print(f"CoreRAG Verbose: Error in re-ranking: {e}")
+        return RagStatus.ERROR, [], "Error during document re-ranking."
+
+
+class BatchingReranker:
+    """
+    Collects re-rank requests from concurrent queries for up to max_wait_seconds (or max_batch_size
+    requests) and sends them to Gemini as one prompt, so a burst of queries pays for one round trip
+    and one prefill instead of one each. Requests run on their own if they arrive alone, or if the
+    batched call fails or leaves their section out.
+    """
+
+    def __init__(self, max_batch_size: int = RERANK_BATCH_MAX_SIZE,
+                 max_wait_seconds: float = RERANK_BATCH_WINDOW_SECONDS):
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._requests = queue.Queue()  # (model, user_query, pages, verbose, Future)
+        self._collector = None
+        self._collector_lock = threading.Lock()
+
+    def rerank(self, model: genai.GenerativeModel, user_query: str, pages: list[dict],
+               verbose: bool = False) -> tuple[RagStatus, list[str], str]:
+        """Same result as rerank_shard, blocks until this request's batch has been answered."""
+        with self._collector_lock:
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect_batches, name="rag-rerank-batcher",
+                                                   daemon=True)
+                self._collector.start()
+        result = Future()
+        self._requests.put((model, user_query, pages, verbose, result))
+        return result.result()
+
+    def _collect_batches(self):
+        while True:
+            batch = [self._requests.get()]  # The window opens with the first request
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            # Requests for different models can't share a call
+            batches_by_model = {}
+            for request in batch:
+                batches_by_model.setdefault(id(request[0]), []).append(request)
+            for model_batch in batches_by_model.values():
+                _background_executor.submit(self._run_batch, model_batch)
+
+    @staticmethod
+    def _run_batch(batch: list):
+        try:
+            BatchingReranker._answer_batch(batch)
+        except Exception as e:
+            # Every request needs an outcome, or its rerank() call would block forever
+            for *_, result in batch:
+                if not result.done():
+                    result.set_exception(e)
+
+    @staticmethod
+    def _answer_batch(batch: list):
+        model = batch[0][0]
+        verbose = any(request[3] for request in batch)
+        results_by_number = {}
+        if len(batch) > 1:
+            if verbose: print(f"CoreRAG Verbose: Re-ranking {len(batch)} queries in one batched call.")
+            prompt = construct_batched_rerank_prompt([(user_query, pages) for _, user_query, pages, _, _ in batch])
+            try:
+                with _rerank_call_slots:
+                    response = model.generate_content(prompt)
+                if response.parts and not (response.prompt_feedback and response.prompt_feedback.block_reason):
+                    results_by_number = parse_batched_reranked_results(response.text)
+            except Exception as e:
+                if verbose: print(f"CoreRAG Verbose: Batched re-ranking failed, re-ranking one by one: {e}")
+        for number, (_, user_query, pages, request_verbose, result) in enumerate(batch, 1):
+            reranked_urls = results_by_number.get(number)
+            if reranked_urls:
+                result.set_result((RagStatus.OK, reranked_urls, ""))
+            else:  # Missing from the batched answer, or a blocked batch, so it gets a call of its own
+                result.set_result(rerank_shard(model, user_query, pages, verbose=request_verbose))
+
+
+_batching_reranker = BatchingReranker()
+
+
+def get_cross_encoder_text(page: dict) -> str:
+    """Returns the page's title and top keywords as the cross-encoder sees them, stored on the page like its snippet."""
+    text = page.get('_cross_encoder_text')
+    if text is None:
+        keywords = page.get('keywords', ())
+        if not isinstance(keywords, tuple):  # Page didn't come from the search index
+            keywords = normalize_doc_keywords(keywords)
+        kw_str = " ".join(kw for kw, _ in keywords[:MAX_KEYWORDS_PER_PAGE_IN_PROMPT])
+        text = page['_cross_encoder_text'] = f"{page.get('title', '')} {kw_str}".strip()
+    return text
+
+
+def rerank_pages_locally(user_query: str, pages: list[dict],
+                         verbose: bool = False) -> tuple[RagStatus, list[str], str]:
+    """
+    Re-ranks the first RERANK_MAX_CANDIDATES pages with the local cross-encoder.
+    Returns the same triple as rerank_shard.
+    """
+    pages = [page for page in pages if page.get('url')][:RERANK_MAX_CANDIDATES]
+    scores = score_passages(user_query, [get_cross_encoder_text(page) for page in pages])
+    if not scores:
+        return RagStatus.PARSE_FAIL, [], "Re-ranking did not identify relevant pages."
+    ranked = sorted(zip(scores, range(len(pages))), key=lambda scored: -scored[0])  # Stable, ties keep search order
+    if verbose:
+        top_pages = ", ".join(f"{pages[i].get('title', 'N/A')} ({score:.2f})" for score, i in ranked[:10])
+        print(f"CoreRAG Verbose: Cross-encoder re-ranked top pages: {top_pages}")
+    return RagStatus.OK, [pages[i]['url'] for _, i in ranked], ""
+
+
+def rerank_pages(model: genai.GenerativeModel, user_query: str, pages: list[dict],
+                 verbose: bool = False) -> tuple[RagStatus, list[str], str]:
+    """
+    Re-ranks pages with the local cross-encoder, or with Gemini when RERANK_BACKEND is "gemini"
+    or the cross-encoder can't be used.
+    Gemini re-ranks go like rerank_shard, batched with other queries' re-ranks. Long result lists
+    are split into up to RERANK_MAX_SHARDS contiguous shards that are re-ranked concurrently, so
+    latency is that of the slowest shard rather than of one huge prompt. Shard rankings are
+    merged rank by rank, best shard first since pages arrive in search order.
+    """
+    if RERANK_BACKEND != "gemini":
+        try:
+            return rerank_pages_locally(user_query, pages, verbose=verbose)
+        except Exception as e:
+            if verbose: print(f"CoreRAG Verbose: Cross-encoder re-ranking failed, using Gemini: {e}")
+
+    # Shards stay at most RERANK_SHARD_SIZE pages, hits beyond what they can hold are dropped (search order)
+    pages = pages[:RERANK_SHARD_SIZE * RERANK_MAX_SHARDS]
+    num_shards = -(-len(pages) // RERANK_SHARD_SIZE)
+    if num_shards <= 1:
+        return _batching_reranker.rerank(model, user_query, pages, verbose=verbose)
+
+    shard_size = -(-len(pages) // num_shards)
+    shards = [pages[i:i + shard_size] for i in range(0, len(pages), shard_size)]
+    if verbose: print(f"CoreRAG Verbose: Re-ranking in {len(shards)} concurrent shards of up to {shard_size} pages.")
+    shard_results = list(_background_executor.map(lambda shard: rerank_shard(model, user_query, shard, verbose),
+                                                  shards))
+    ranked_url_lists = [urls for status, urls, _ in shard_results if status is RagStatus.OK]
+    if not ranked_url_lists:
+        return shard_results[0]  # Every shard failed, report why the best one did
+    merged_urls = dict.fromkeys(url for same_rank_urls in itertools.zip_longest(*ranked_url_lists)
+                                for url in same_rank_urls if url)
+    return RagStatus.OK, list(merged_urls), ""
+
+
+def index_pages_by_url(pages: list[dict]) -> dict[str, dict]:
+    """Maps each URL to its page, reversed() so the first page with a given URL wins, as with a linear scan."""
+    return {d['url']: d for d in reversed(pages) if d.get('url')}
+
+
+def get_top_matching_keyword_weight(page: dict, user_query: str) -> float:
+    """Returns the highest weight among page's keywords that occur in user_query, 0.0 when none do."""
+    query_tokens = set(tokenize_for_bm25(user_query))
+    return max((weight for keyword, weight in page.get('keywords', ()) if keyword.lower() in query_tokens),
+               default=0.0)
+
+
+def get_answering_urls(reranked_urls: list[str], url_to_doc: dict[str, dict]) -> list[str]:
+    """Returns the reranked URLs whose pages get_content_for_answering puts into the context."""
+    return [url for url in reranked_urls[:MAX_PAGES_FOR_ANSWERING] if url in url_to_doc]
+
+
+def get_context_cache(model: genai.GenerativeModel, doc_urls: list[str], context_text: str,
+                      verbose: bool = False):
+    """
+    Returns a Gemini CachedContent holding context_text, keyed by the text itself since the
+    passages taken from doc_urls depend on the query, so any turn that ends up with the same
+    context reuses it. Returns None when caching isn't possible.
+    """
+    global _context_caching_available, _context_caching_retry_at
+    if (not _context_caching_available or time.monotonic() < _context_caching_retry_at
+            or len(context_text) < CONTEXT_CACHE_MIN_CHARS):
+        return None
+
+    key = hashlib.blake2b(context_text.encode()).digest()
+    # Leave a margin so a cache can't expire between this check and the request
+    usable_until = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    with _context_caches_lock:
+        cached = _context_caches.get(key)
+        if cached and cached.expire_time > usable_until:
+            if verbose: print(f"CoreRAG Verbose: Reusing context cache {cached.name}")
+            return cached
+        # Only one thread creates a given cache, the others wait for it instead of holding the lock
+        # across the API call or creating duplicates
+        creation = _context_cache_creations.get(key)
+        is_creator = creation is None
+        if is_creator:
+            creation = _context_cache_creations[key] = Future()
+    if not is_creator:
+        return creation.result()
+
+    cached = None
+    try:
+        cached = caching.CachedContent.create(model=model.model_name, contents=[context_text],
+                                              ttl=CONTEXT_CACHE_TTL)
+        if verbose: print(f"CoreRAG Verbose: Created context cache {cached.name} for {len(doc_urls)} pages")
+    except (google_exceptions.PermissionDenied, google_exceptions.InvalidArgument) as e:
+        if verbose: print(f"CoreRAG Verbose: Context caching unavailable, sending context inline: {e}")
+        _context_caching_available = False
+    except Exception as e:
+        if verbose: print(f"CoreRAG Verbose: Could not create context cache, retrying in "
+                          f"{CONTEXT_CACHE_RETRY_SECONDS}s: {e}")
+        _context_caching_retry_at = time.monotonic() + CONTEXT_CACHE_RETRY_SECONDS
+    finally:
+        with _context_caches_lock:
+            del _context_cache_creations[key]
+            if cached:
+                for stale_key in [k for k, c in _context_caches.items() if c.expire_time <= usable_until]:
+                    del _context_caches[stale_key]
+                _context_caches[key] = cached
+        creation.set_result(cached)
+    return cached
+
+
+def format_context_block(url: str, title: str, text: str) -> str:
+    """
+    Returns the context block for one page. Not cached, since text is the page's passages
+    selected for the current query.
+    """
+    return f"\n\n--- Context from {title} ({url}) ---\n{text if text else 'No text content.'}"
 
 
-def get_content_for_answering(reranked_urls: list[str], all_local_pages: list[dict], verbose: bool = False) -> str:
-    content = ""
-    found_count = 0
-    if not reranked_urls: return "No documents identified as relevant by re-ranking."
+def tokenize_for_bm25(text: str) -> list[str]:
+    return _BM25_TOKEN_RE.findall(text.lower())
+
+
+@functools.lru_cache(maxsize=CONTEXT_BLOCK_CACHE_SIZE)
+def get_page_passages(url: str, text: str) -> tuple[list[str], BM25Okapi]:
+    """
+    Packs a page's sentences into passages of about PASSAGE_CHARS characters and returns them
+    with a BM25 index over them. Crawled text is a single line, so it is split on sentence ends,
+    and sentences longer than a passage (tables, lists) on words.
+    Cached per page, only the query scoring runs per turn.
+    """
+    passages = []
+    current_pieces, current_length = [], 0
+    for sentence in _SENTENCE_END_RE.split(text):
+        for piece in sentence.split() if len(sentence) > PASSAGE_CHARS else (sentence,):
+            if current_pieces and current_length + len(piece) > PASSAGE_CHARS:
+                passages.append(" ".join(current_pieces))
+                current_pieces, current_length = [], 0
+            current_pieces.append(piece)
+            current_length += len(piece) + 1
+    if current_pieces:
+        passages.append(" ".join(current_pieces))
+    return passages, BM25Okapi([tokenize_for_bm25(passage) for passage in passages])
+
+
+def select_passages(url: str, text: str, query: str, max_chars: int = MAX_CONTEXT_CHARS_PER_PAGE) -> str:
+    """
+    Returns text unchanged if it fits in max_chars, otherwise the passages that best match
+    query by BM25, in page order, up to max_chars. Pages no query term matches keep their start.
+    """
+    if len(text) <= max_chars:
+        return text
+    passages, bm25 = get_page_passages(url, text)
+    scores = bm25.get_scores(tokenize_for_bm25(query))
+    selected_indices, selected_chars = [], 0
+    for i in sorted(range(len(passages)), key=lambda i: (-scores[i], i)):
+        if selected_chars + len(passages[i]) <= max_chars:
+            selected_indices.append(i)
+            selected_chars += len(passages[i]) + 1
+    if not selected_indices:  # Even the best passage is over budget
+        return passages[int(scores.argmax())][:max_chars]
+    return "\n".join(passages[i] for i in sorted(selected_indices))
+
+
+def get_content_for_answering(reranked_urls: list[str], url_to_doc: dict[str, dict], user_query: str,
+                              verbose: bool = False) -> tuple[RagStatus, str]:
+    content_parts = []
+    if not reranked_urls: return RagStatus.NO_RESULTS, "No documents identified as relevant by re-ranking."
     for url in reranked_urls[:MAX_PAGES_FOR_ANSWERING]:
-        doc = next((d for d in all_local_pages if d.get('url') == url), None)
+        doc = url_to_doc.get(url)
         if doc:
-            found_count += 1
-            text = doc.get('text', '')
-            title = doc.get('title', 'N/A')
-            content += f"\n\n--- Context from {title} ({url}) ---\n{text if text else 'No text content.'}"
+            text = select_passages(url, doc.get('text') or '', user_query)
+            content_parts.append(format_context_block(url, doc.get('title', 'N/A'), text))
         elif verbose:
             print(f"CoreRAG Verbose: Doc for URL {url} not found in local_pages.")
-    return content if found_count else "No content retrieved for re-ranked pages."
+    if not content_parts:
+        return RagStatus.NO_RESULTS, "No content retrieved for re-ranked pages."
+    return RagStatus.OK, "".join(content_parts)
 
 
 def construct_answer_prompt_for_chat_turn(current_user_query: str, context_text: str) -> str:
     return (f"User's current query: \"{current_user_query}\"\n\n"
             f"Context from knowledge base:\n--- START ---\n{context_text}\n--- END ---\n\n"
-            "Task: Given ongoing chat & new context, answer current query. Prioritize new context. If info lacking, say so. No external knowledge.")
+            f"{ANSWER_INSTRUCTIONS}")
+
+
+def construct_answer_prompt_for_cached_context(current_user_query: str) -> str:
+    return (f"User's current query: \"{current_user_query}\"\n\n"
+            f"{CACHED_CONTEXT_ANSWER_INSTRUCTIONS}")
+
+
+def iter_response_text(response) -> Iterator[str]:
+    """Yields the text of each chunk of a streamed Gemini response as it arrives."""
+    for chunk in response:
+        if chunk.parts:
+            yield chunk.text
+
+
+def discard_broken_turn(chat_session: genai.ChatSession, verbose: bool = False) -> bool:
+    """
+    Drops the last turn if its streamed response stopped early (e.g. a mid-answer safety stop
+    or a dropped connection). Otherwise every later access to chat_session.history would raise.
+    Returns whether the turn was dropped.
+    """
+    try:
+        chat_session.history
+    except genai.types.BrokenResponseError:
+        if verbose: print("CoreRAG Verbose: Streamed answer was incomplete, dropping it from the chat history.")
+        chat_session.rewind()
+        return True
+    return False
+
+
+def drop_context_from_last_turn(chat_session: genai.ChatSession, current_user_query: str):
+    """
+    Replaces the answer prompt of the last turn in the history with just the query, so the
+    retrieved context isn't resent (and prefilled again) with every later turn. Each turn
+    retrieves its own context, and the answer it produced stays in the history.
+    """
+    history = chat_session.history
+    if len(history) >= 2 and history[-2].role == "user":
+        chat_session.history = [*history[:-2], {"role": "user", "parts": [current_user_query]}, history[-1]]
+
+
+def stream_answer_with_context_cache(chat_session: genai.ChatSession, model: genai.GenerativeModel,
+                                     context_cache, current_user_query: str) -> Iterator[str]:
+    """
+    Streams the answer for the turn with the retrieved context served from context_cache instead
+    of inline. The chat history is sent as usual and, once the answer completes, the new turn is
+    appended to chat_session.history, with just the query as its user message.
+    """
+    cached_model = genai.GenerativeModel.from_cached_content(
+        context_cache, safety_settings=SAFETY_SETTINGS)
+    contents = [*chat_session.history,
+                {"role": "user", "parts": [construct_answer_prompt_for_cached_context(current_user_query)]}]
+    response = cached_model.generate_content(contents, stream=True)
+    if response.prompt_feedback and response.prompt_feedback.block_reason:
+        yield f"My response was blocked. Reason: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason}"
+        return
+    yield from iter_response_text(response)
+    if response.parts and response.candidates[0].finish_reason in COMPLETE_FINISH_REASONS:
+        chat_session.history = [*contents[:-1], {"role": "user", "parts": [current_user_query]},
+                                response.candidates[0].content]
 
 
 def construct_llm_search_guidance_prompt(user_query: str, history_snippet: str, kb_topic: str) -> str:
-    return (f"User's query: \"{user_query}\"\nKB search about \"{kb_topic}\" failed.\n{history_snippet}\n"
-            "Based on query & chat, suggest an improved search query (2-5 words) for my KB. Output ONLY the query string.\n"
-            "Example: if user asked 'which one?' after 'Barbarian subclasses', suggest 'Barbarian subclass comparison'.")
+    return (f"{SEARCH_GUIDANCE_INSTRUCTIONS}\n\n"
+            f"User's query: \"{user_query}\"\nKB search about \"{kb_topic}\" failed.\n{history_snippet}")
 
 
-# --- Main Processing Function for the RAG Core ---
-def process_query_with_rag_chat(
+def warm_up(verbose: bool = False):
+    """
+    Loads the search index and the MiniLM/KeyBERT model, which otherwise happens on the first
+    query and adds seconds to it. Blocking, meant to run in a background thread at startup.
+    """
+    if verbose: print("CoreRAG Verbose: Warming up search index and embedding model...")
+    try:
+        get_index()
+        embed_text("warm up")  # The first call also initializes torch's kernels
+    except Exception as e:
+        print(f"Warning: Warm-up failed, loading on the first query instead: {e}")
+        return
+    if verbose: print("CoreRAG Verbose: Warm-up done.")
+
+
+# --- Main Processing Functions for the RAG Core ---
+def retrieve_context_for_answering(
         user_query: str,
-        chat_session: genai.ChatSession,  # Pass the user's specific chat session
+        chat_session: genai.ChatSession,
         model: genai.GenerativeModel,
-        knowledge_base_topic: str = DEFAULT_KNOWLEDGE_BASE_TOPIC,  # Allow overriding
+        knowledge_base_topic: str,
+        query_embedding,
         verbose: bool = False
-) -> str:
+) -> tuple[RagStatus, str, list[str]]:
     """
-    Processes a single user query using the RAG pipeline and the provided chat session.
+    Runs the search and re-ranking stages for user_query.
+    Returns the retrieval status, the context text for the answer prompt and the URLs of the pages in it.
+    Results are reused for any later query whose embedding is close enough to query_embedding.
     """
-    if verbose: print(f"\nCoreRAG Verbose: Processing query: '{user_query}'")
+    cached_retrieval = _retrieval_cache.get(query_embedding)
+    if cached_retrieval is not None:
+        if verbose: print("CoreRAG Verbose: Semantic cache hit, reusing search & re-ranking results.")
+        return cached_retrieval
+
+    history_for_guidance = chat_session.history or []
+    guidance_prompt_str = None
+    guidance_future = None
+    # Short follow-ups ("which one?") usually miss the keyword search, so their guidance
+    # query is requested up front and runs while the local search does
+    if history_for_guidance and len(user_query.split()) <= SPECULATIVE_GUIDANCE_MAX_WORDS:
+        guidance_prompt_str = construct_llm_search_guidance_prompt(
+            user_query, format_chat_history_snippet(history_for_guidance, NUM_HISTORY_TURNS_FOR_GUIDANCE),
+            knowledge_base_topic)
+        if verbose: print("CoreRAG Verbose: Requesting LLM search guidance speculatively.")
+        guidance_future = _background_executor.submit(model.generate_content, guidance_prompt_str)
 
     # Stage 1: Initial local search
     if verbose: print("CoreRAG Verbose: Step 1: Initial local search...")
     local_pages = search_documents(user_query)
 
     # Stage 1b: LLM-Guided Search Augmentation
-    if not local_pages:
+    used_search_guidance = not local_pages
+    if used_search_guidance:
         if verbose: print("CoreRAG Verbose: Initial search failed. Attempting LLM-guided search.")
-        history_for_guidance = chat_session.history or []
-        formatted_hist_snippet = format_chat_history_snippet(history_for_guidance, NUM_HISTORY_TURNS_FOR_GUIDANCE)
-        guidance_prompt_str = construct_llm_search_guidance_prompt(user_query, formatted_hist_snippet,
-                                                                   knowledge_base_topic)
+        if guidance_prompt_str is None:
+            formatted_hist_snippet = format_chat_history_snippet(history_for_guidance, NUM_HISTORY_TURNS_FOR_GUIDANCE)
+            guidance_prompt_str = construct_llm_search_guidance_prompt(user_query, formatted_hist_snippet,
+                                                                       knowledge_base_topic)
         if verbose: print(f"CoreRAG Verbose: --- LLM Guidance Prompt ---\n{guidance_prompt_str}\n--- End ---")
         try:
-            guidance_response = model.generate_content(guidance_prompt_str)
+            if guidance_future is not None:
+                guidance_response = guidance_future.result()
+            else:
+                guidance_response = model.generate_content(guidance_prompt_str)
             suggested_query = guidance_response.text.strip() if guidance_response.parts else ""
             if guidance_response.prompt_feedback and guidance_response.prompt_feedback.block_reason:
                 if verbose: print(
@@ -133,51 +692,179 @@ def process_query_with_rag_chat(
             if verbose: print(f"CoreRAG Verbose: Error in LLM-guided search: {e}")
 
     # Stage 2: Re-ranking
+    status = RagStatus.NO_RESULTS
     context_for_answering = "No specific documents found in the knowledge base for your query."
-    if local_pages:
-        if verbose: print(f"CoreRAG Verbose: Step 2: Re-ranking {len(local_pages)} pages...")
-        rerank_context_str = format_local_results_for_rerank_prompt(local_pages)
-        rerank_prompt = construct_rerank_prompt(user_query, rerank_context_str)  # Use original query
-        if verbose: print(f"CoreRAG Verbose: --- Re-rank Prompt ---\n{rerank_prompt}\n--- End ---")
-        try:
-            rerank_response = model.generate_content(rerank_prompt)
-            reranked_urls = []
-            if rerank_response.prompt_feedback and rerank_response.prompt_feedback.block_reason:
-                if verbose: print(
-                    f"CoreRAG Verbose: Re-ranking blocked: {rerank_response.prompt_feedback.block_reason_message or rerank_response.prompt_feedback.block_reason}")
-                context_for_answering = "Re-ranking of local documents was blocked."
-            elif rerank_response.parts:
-                if verbose: print(
-                    f"CoreRAG Verbose: --- Gemini's Re-ranked (Raw) ---\n{rerank_response.text}\n--- End ---")
-                reranked_urls = parse_reranked_results(rerank_response.text)
-                if reranked_urls:
-                    context_for_answering = get_content_for_answering(reranked_urls, local_pages, verbose=verbose)
-                else:
-                    context_for_answering = "Re-ranking did not identify relevant pages."
+    answering_urls = []
+    url_to_doc = index_pages_by_url(local_pages)  # Built once for the final set of pages
+    top_keyword_weight = get_top_matching_keyword_weight(local_pages[0], user_query) if local_pages else 0.0
+    if 0 < len(local_pages) <= MAX_PAGES_FOR_ANSWERING or top_keyword_weight >= RERANK_SKIP_KEYWORD_WEIGHT:
+        # Every page makes it into the answer anyway, or the best local match is confident
+        # enough, so re-ranking would change little and the local order is used as is
+        if verbose:
+            if len(local_pages) <= MAX_PAGES_FOR_ANSWERING:
+                print(f"CoreRAG Verbose: Step 2: Only {len(local_pages)} pages found, skipping re-ranking.")
             else:
-                context_for_answering = "Re-ranking process yielded no specific pages."
-        except Exception as e:
-            if verbose: print(f"CoreRAG Verbose: Error in re-ranking: {e}")
-            context_for_answering = "Error during document re-ranking."
+                print(f"CoreRAG Verbose: Step 2: Top page matches a query keyword with weight "
+                      f"{top_keyword_weight:.2f}, skipping re-ranking.")
+        found_urls = [page['url'] for page in local_pages if page.get('url')]
+        status, context_for_answering = get_content_for_answering(found_urls, url_to_doc, user_query, verbose=verbose)
+        answering_urls = get_answering_urls(found_urls, url_to_doc)
+    elif local_pages:
+        if verbose: print(f"CoreRAG Verbose: Step 2: Re-ranking {len(local_pages)} pages...")
+        status, reranked_urls, context_for_answering = rerank_pages(model, user_query, local_pages, verbose=verbose)
+        if status is RagStatus.OK:
+            status, context_for_answering = get_content_for_answering(reranked_urls, url_to_doc,
+                                                                      user_query, verbose=verbose)
+            answering_urls = get_answering_urls(reranked_urls, url_to_doc)
     elif verbose:
         print("CoreRAG Verbose: No local pages to re-rank.")
 
+    # Guided results depend on the chat history, so only results for the query alone are shared
+    if status is RagStatus.OK and not used_search_guidance:
+        _retrieval_cache.set(query_embedding, (status, context_for_answering, answering_urls))
+    return status, context_for_answering, answering_urls
+
+
+def process_query_with_rag_chat(
+        user_query: str,
+        chat_session: genai.ChatSession,  # Pass the user's specific chat session
+        model: genai.GenerativeModel,
+        knowledge_base_topic: str = DEFAULT_KNOWLEDGE_BASE_TOPIC,  # Allow overriding
+        verbose: bool = False,
+        query_embedding=None
+) -> str:
+    """
+    Processes a single user query using the RAG pipeline and the provided chat session.
+    """
+    return "".join(stream_query_with_rag_chat(user_query, chat_session, model, knowledge_base_topic, verbose,
+                                              query_embedding))
+
+
+def stream_query_with_rag_chat(
+        user_query: str,
+        chat_session: genai.ChatSession,  # Pass the user's specific chat session
+        model: genai.GenerativeModel,
+        knowledge_base_topic: str = DEFAULT_KNOWLEDGE_BASE_TOPIC,  # Allow overriding
+        verbose: bool = False,
+        query_embedding=None  # embed_text(user_query), computed here when not passed
+) -> Iterator[str]:
+    """
+    Processes a single user query using the RAG pipeline and the provided chat session,
+    yielding the answer text chunk by chunk as Gemini streams it.
+    """
+    if verbose: print(f"\nCoreRAG Verbose: Processing query: '{user_query}'")
+
+    # Shrinks a long history while retrieval runs, it has to finish before the answer is sent
+    compaction_future = _background_executor.submit(compact_chat_history, chat_session, model, verbose)
+    if query_embedding is None:
+        query_embedding = embed_text(user_query)
+    status, context_for_answering, answering_urls = retrieve_context_for_answering(
+        user_query, chat_session, model, knowledge_base_topic, query_embedding, verbose=verbose)
+    compaction_future.result()
+
     # Stage 3: Gemini Answering
     if verbose: print("CoreRAG Verbose: Step 3: Asking Gemini to answer...")
-    answer_prompt_for_turn = construct_answer_prompt_for_chat_turn(user_query, context_for_answering)
-    if verbose: print(f"CoreRAG Verbose: --- Answer Prompt (Context) ---\n{answer_prompt_for_turn}\n--- End ---")
+    if verbose and status is not RagStatus.OK:
+        print(f"CoreRAG Verbose: No page context for the answer ({status.name}), answering from the chat alone.")
+    context_cache = get_context_cache(model, answering_urls, context_for_answering,
+                                      verbose=verbose) if status is RagStatus.OK else None
 
+    answered = False  # Set once a (possibly empty) answer stream completed
+    yielded_text = False
     try:
-        final_answer_response = chat_session.send_message(answer_prompt_for_turn)  # Uses the passed chat_session
-        if final_answer_response.prompt_feedback and final_answer_response.prompt_feedback.block_reason:
-            return f"My response was blocked. Reason: {final_answer_response.prompt_feedback.block_reason_message or final_answer_response.prompt_feedback.block_reason}"
-        elif final_answer_response.parts:
-            return final_answer_response.text
-        return "I received an empty response and wasn't blocked. Not sure how to reply."
+        if context_cache:
+            try:
+                for text in stream_answer_with_context_cache(chat_session, model, context_cache, user_query):
+                    yielded_text = True
+                    yield text
+                answered = True
+            except Exception as e:
+                if yielded_text:
+                    raise  # Part of the answer is already out, don't start a second one
+                if verbose: print(f"CoreRAG Verbose: Cached-context answer failed, sending context inline: {e}")
+        if not answered:
+            answer_prompt_for_turn = construct_answer_prompt_for_chat_turn(user_query, context_for_answering)
+            if verbose: print(f"CoreRAG Verbose: --- Answer Prompt (Context) ---\n{answer_prompt_for_turn}\n--- End ---")
+            try:
+                final_answer_response = chat_session.send_message(answer_prompt_for_turn, stream=True)  # Uses the passed chat_session
+            except genai.types.BlockedPromptException as e:
+                yield f"My response was blocked. Reason: {e}"
+                return
+            streamed = False
+            try:
+                for text in iter_response_text(final_answer_response):
+                    yielded_text = True
+                    yield text
+                streamed = True
+            finally:
+                if not discard_broken_turn(chat_session, verbose=verbose) and streamed:
+                    drop_context_from_last_turn(chat_session, user_query)
+        if not yielded_text:
+            yield "I received an empty response and wasn't blocked. Not sure how to reply."
     except Exception as e:
         if verbose: print(f"CoreRAG Verbose: Error in final answering: {e}")
-        return f"An error occurred while formulating an answer: {e}"
+        yield f"An error occurred while formulating an answer: {e}"
+
+
+# --- Batch Mode ---
+def read_batch_queries(filepath: str) -> list[str]:
+    """Reads one query per line, each either a JSON string or an object with a "query" field."""
+    queries = []
+    with open(filepath, 'rb') as infile:
+        for line_number, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                print(f"Warning: Could not parse line {line_number} in {filepath}. Skipping.")
+                continue
+            query = entry.get('query') if isinstance(entry, dict) else entry
+            if isinstance(query, str) and query.strip():
+                queries.append(query)
+    return queries
+
+
+async def run_batch(queries: list[str], model: genai.GenerativeModel, concurrency: int,
+                    knowledge_base_topic: str = DEFAULT_KNOWLEDGE_BASE_TOPIC, verbose: bool = False) -> list[str]:
+    """
+    Answers independent queries, each in a fresh chat session, with at most concurrency in flight.
+    The retrieval cache is shared, so near-duplicate queries skip search & re-ranking.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(query: str) -> str:
+        async with semaphore:
+            return await asyncio.to_thread(process_query_with_rag_chat, query, model.start_chat(history=[]),
+                                           model, knowledge_base_topic, verbose)
+
+    return await asyncio.gather(*(run_one(query) for query in queries))
+
+
+# The model is passed into process_query_with_rag_chat, so the bot initializes it once.
+# This entry point only exists for batch runs (evaluation, replaying queries, FAQ answers).
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a batch of queries with the Gemini RAG core")
+    parser.add_argument("--batch-file", required=True,
+                        help="JSONL file with one query per line, as a JSON string or {\"query\": ...}")
+    parser.add_argument("--output", required=True, help="JSONL file to write {\"query\", \"answer\"} results to")
+    parser.add_argument("--concurrency", type=int, default=8, help="Queries processed at the same time.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose RAG logging.")
+    args = parser.parse_args()
 
-# Optional: A function to initialize the Gemini model if you want it self-contained
-# but it's often better to initialize in the main application (bot) once.
-# For now, the model will be passed into process_query_with_rag_chat.
\ No newline at end of file
+    load_dotenv()
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        print("CRITICAL: GEMINI_API_KEY not found in environment.")
+    else:
+        genai.configure(api_key=api_key)
+        batch_model = genai.GenerativeModel(os.environ.get("DEFAULT_GEMINI_MODEL", "gemini-2.0-flash"),
+                                            safety_settings=SAFETY_SETTINGS)
+        batch_queries = read_batch_queries(args.batch_file)
+        print(f"Answering {len(batch_queries)} queries from {args.batch_file} ({args.concurrency} at a time)...")
+        batch_answers = asyncio.run(run_batch(batch_queries, batch_model, max(1, args.concurrency),
+                                              verbose=args.verbose))
+        with open(args.output, 'wb') as outfile:
+            outfile.writelines(orjson.dumps({"query": query, "answer": answer}) + b'\n'
+                               for query, answer in zip(batch_queries, batch_answers))
+        print(f"Wrote {len(batch_answers)} answers to {args.output}")
\ No newline at end of file
@@ -1,18 +1,125 @@
-import json
+import hashlib
+import os
+import pickle
 import random
+import threading
+
+import diskcache
+import numpy as np
+import orjson
+import torch
 from keybert import KeyBERT
+from keybert.backend import BaseEmbedder, SentenceTransformerBackend
+from sentence_transformers import SentenceTransformer
+
+from build_index import get_source_signature, iter_jsonl_lines
+
+KEYWORD_BATCH_SIZE = 64  # Documents per KeyBERT call when extracting keywords in bulk
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'  # KeyBERT's default sentence-transformer
+# Set KEYBERT_QUANTIZED=1 to run the model's Linear layers as dynamically quantized int8 on CPU.
+# Roughly doubles CPU throughput, but embeddings (and keyword weights) shift slightly.
+USE_QUANTIZED_EMBEDDING_MODEL = os.environ.get('KEYBERT_QUANTIZED', '0') == '1'
+# Unset, sentence-transformers picks CUDA or MPS when available. Set KEYBERT_DEVICE=cpu to force the CPU.
+EMBEDDING_DEVICE = os.environ.get('KEYBERT_DEVICE') or None
+GPU_EMBEDDING_BATCH_SIZE = 128  # Texts per forward pass on a GPU, the CPU keeps the default of 32
+# Embeddings of every text and candidate word seen before, kept across runs and processes
+EMBEDDING_CACHE_DIR = 'data/cache/embeddings'
+LINE_OFFSETS_CACHE_DIR = 'data/cache'  # <jsonl name>.offsets.pkl, byte offset of each line for random sampling
+
+_kw_model = None  # Shared KeyBERT model, loaded on first use
+_kw_model_lock = threading.Lock()
+
+class CachedEmbedder(BaseEmbedder):
+    """
+    Wraps a KeyBERT embedding backend so texts it has embedded before, in this or an earlier run,
+    are read from a disk cache keyed by the sha1 of the model name and text. Only the misses go
+    through the transformer, in one batch.
+    """
+
+    def __init__(self, embedder, cache, model_name):
+        super().__init__(embedding_model=embedder.embedding_model)
+        self.embedder = embedder
+        self.cache = cache
+        self.model_name = model_name
+
+    def get_cache_key(self, text):
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def embed(self, documents, verbose=False):
+        if not documents:
+            return self.embedder.embed(documents, verbose)
+        keys = [self.get_cache_key(text) for text in documents]
+        cached = [self.cache.get(key) for key in keys]
+        embeddings = [None if blob is None else np.frombuffer(blob, dtype=np.float32) for blob in cached]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            new_embeddings = np.asarray(self.embedder.embed([documents[i] for i in missing], verbose),
+                                        dtype=np.float32)
+            with self.cache.transact():  # One write transaction for the whole batch
+                for i, embedding in zip(missing, new_embeddings):
+                    self.cache.set(keys[i], embedding.tobytes())
+                    embeddings[i] = embedding
+        return np.vstack(embeddings)
+
+def get_embedding_model_id():
+    """Names the embedding model as loaded, so cached embeddings of the quantized model are kept apart."""
+    return f"{EMBEDDING_MODEL_NAME}-qint8" if USE_QUANTIZED_EMBEDDING_MODEL else EMBEDDING_MODEL_NAME
+
+def load_embedding_model():
+    """Loads the sentence-transformer KeyBERT embeds with, quantized when USE_QUANTIZED_EMBEDDING_MODEL is set."""
+    if not USE_QUANTIZED_EMBEDDING_MODEL:
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, device=EMBEDDING_DEVICE)
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device='cpu')  # Quantized kernels are CPU-only
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def get_kw_model():
+    """
+    Returns the process-wide KeyBERT model, loading its sentence-transformer
+    (all-MiniLM-L6-v2) once instead of on every call. Its embeddings go through a CachedEmbedder.
+    """
+    global _kw_model
+    if _kw_model is None:
+        with _kw_model_lock:
+            if _kw_model is None:
+                embedding_model = load_embedding_model()
+                encode_kwargs = {} if embedding_model.device.type == 'cpu' else {'batch_size': GPU_EMBEDDING_BATCH_SIZE}
+                kw_model = KeyBERT(model=SentenceTransformerBackend(embedding_model, **encode_kwargs))
+                kw_model.model = CachedEmbedder(kw_model.model, diskcache.Cache(EMBEDDING_CACHE_DIR),
+                                                get_embedding_model_id())
+                _kw_model = kw_model
+    return _kw_model
+
+def embed_text(input_text):
+    """
+    Embeds a string with the same MiniLM model KeyBERT uses and returns a 1-D numpy array.
+    """
+    return get_kw_model().model.embed([input_text])[0]
 
 def extract_keywords(input_text):
     """
     Prompts the user for a string and extracts keywords from it.
     """
 
-    kw_model = KeyBERT()
+    kw_model = get_kw_model()
     keywords = kw_model.extract_keywords(input_text)
     print("--- Keywords from your input ---")
     print(keywords)
     return keywords
 
+def extract_keywords_batch(input_texts):
+    """
+    Extracts keywords from every text in input_texts with a single KeyBERT call, so the document
+    and candidate word embeddings are computed in batches. Returns one keyword list per text.
+    """
+    if not input_texts:
+        return []
+    keywords = get_kw_model().extract_keywords(input_texts)
+    if len(input_texts) == 1:
+        return [keywords]  # KeyBERT unwraps the result for a single document
+    if not keywords:
+        return [[] for _ in input_texts]  # None of the texts had candidate words
+    return keywords
+
 def extract_keyword_from_user_input():
     """
     Prompts the user for a string and extracts keywords from it.
@@ -22,19 +129,43 @@ def extract_keyword_from_user_input():
     return extract_keywords(user_prompt)
 
 
+def get_line_offsets(filepath):
+    """
+    Returns the byte offset of every non-blank line in filepath. They are pickled next to the
+    other caches and rebuilt whenever filepath changes, so sampling lines never reads the whole file.
+    """
+    offsets_path = os.path.join(LINE_OFFSETS_CACHE_DIR, f"{os.path.basename(filepath)}.offsets.pkl")
+    source_signature = get_source_signature(filepath)
+    try:
+        with open(offsets_path, 'rb') as infile:
+            cached = pickle.load(infile)
+        if cached.get('source_signature') == source_signature:
+            return cached['offsets']
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    offsets = []
+    position = 0
+    for line in iter_jsonl_lines(filepath):
+        if line.strip():
+            offsets.append(position)
+        position += len(line)
+    try:
+        os.makedirs(LINE_OFFSETS_CACHE_DIR, exist_ok=True)
+        with open(offsets_path, 'wb') as outfile:
+            pickle.dump({'source_signature': source_signature, 'offsets': offsets}, outfile,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print(f"Warning: Could not save line offsets to {offsets_path}: {e}")
+    return offsets
+
 def extract_keywords_from_file_samples(filepath="data/raw/bg3_wiki_data.jsonl", num_samples=3):
     """
-    Reads a JSONL file, extracts text from random samples,
-    prints the text, and then extracts and prints keywords from that text.
+    Samples random lines of a JSONL file through its line offsets, so only the sampled
+    entries are read and parsed, prints their text, and then extracts and prints keywords from that text.
     """
-    all_entries = []
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    all_entries.append(json.loads(line))
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode JSON from line: {line.strip()}")
+        line_offsets = get_line_offsets(filepath)
     except FileNotFoundError:
         print(f"Error: File not found at {filepath}")
         return
@@ -42,24 +173,33 @@ def extract_keywords_from_file_samples(filepath="data/raw/bg3_wiki_data.jsonl",
         print(f"An error occurred while reading the file: {e}")
         return
 
-    if not all_entries:
+    if not line_offsets:
         print(f"No data found or loaded from {filepath}")
         return
 
     # Ensure we don't try to sample more items than available
-    actual_samples_to_take = min(num_samples, len(all_entries))
+    actual_samples_to_take = min(num_samples, len(line_offsets))
     if actual_samples_to_take < num_samples:
-        print(f"Warning: Requested {num_samples} samples, but only {len(all_entries)} entries are available. Using {actual_samples_to_take}.")
+        print(f"Warning: Requested {num_samples} samples, but only {len(line_offsets)} entries are available. Using {actual_samples_to_take}.")
 
     if actual_samples_to_take == 0:
         print("No entries to sample from.")
         return
 
-    selected_entries = random.sample(all_entries, actual_samples_to_take)
-
-    kw_model = KeyBERT() # Initialize model once
+    selected_entries = []
+    with open(filepath, 'rb') as f:
+        for offset in random.sample(line_offsets, actual_samples_to_take):
+            f.seek(offset)
+            line = f.readline()
+            try:
+                selected_entries.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                print(f"Warning: Could not decode JSON from line: {line.decode('utf-8', 'replace').strip()}")
+    actual_samples_to_take = len(selected_entries)
 
     print(f"\n--- Extracting keywords from {actual_samples_to_take} random samples from {filepath} ---")
+    texts = [entry.get("text") for entry in selected_entries if entry.get("text")]
+    keywords_by_text = iter(extract_keywords_batch(texts))  # One batched call for all samples
     for i, entry in enumerate(selected_entries):
         print(f"\n--- Sample {i+1}/{actual_samples_to_take} ---")
         text_content = entry.get("text") # Safely get the 'text' field
@@ -69,7 +209,7 @@ def extract_keywords_from_file_samples(filepath="data/raw/bg3_wiki_data.jsonl",
             print(text_content)
             print("-" * 20)
 
-            keywords = kw_model.extract_keywords(text_content)
+            keywords = next(keywords_by_text)
             print("Extracted Keywords:")
             print(keywords)
         else:
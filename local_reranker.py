@@ -0,0 +1,58 @@
+# local_reranker.py
+import os
+import threading
+
+from sentence_transformers import CrossEncoder
+
+CROSS_ENCODER_MODEL_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+# Dynamically int8-quantized ONNX export shipped in the model repo, run by ONNX Runtime on CPU.
+# Set CROSS_ENCODER_QUANTIZED=0 to run the FP32 PyTorch model instead.
+PREDICT_BATCH_SIZE = 32  # (query, passage) pairs per forward pass
+QUANTIZED_MODEL_FILE = 'onnx/model_qint8_avx512_vnni.onnx'
+USE_QUANTIZED_MODEL = os.environ.get('CROSS_ENCODER_QUANTIZED', '1') != '0'
+# ONNX Runtime intra-op threads for the quantized model, defaults to half the cores to leave the rest to the bot
+# and KeyBERT. Predictions are serialized, so concurrent re-ranks never run more threads than this.
+CROSS_ENCODER_THREADS = max(1, int(os.environ.get('CROSS_ENCODER_THREADS', 0)) or (os.cpu_count() or 2) // 2)
+
+_cross_encoder = None  # Shared cross-encoder, loaded on first use
+_cross_encoder_lock = threading.Lock()
+_predict_lock = threading.Lock()  # One forward pass at a time, concurrent calls would oversubscribe the cores
+
+
+def get_cross_encoder():
+    """Returns the process-wide cross-encoder, loading it once instead of on every re-rank."""
+    global _cross_encoder
+    if _cross_encoder is None:
+        with _cross_encoder_lock:
+            if _cross_encoder is None:
+                _cross_encoder = load_cross_encoder()
+    return _cross_encoder
+
+
+def load_cross_encoder():
+    """Loads the int8 ONNX cross-encoder, falling back to the FP32 one when ONNX Runtime can't load it."""
+    if USE_QUANTIZED_MODEL:
+        try:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = CROSS_ENCODER_THREADS
+            return CrossEncoder(CROSS_ENCODER_MODEL_NAME, backend='onnx', model_kwargs={
+                'file_name': QUANTIZED_MODEL_FILE,
+                'provider': 'CPUExecutionProvider',
+                'session_options': session_options,
+            })
+        except (ImportError, OSError) as e:
+            # ONNX dependencies missing, or the quantized file isn't in the model repo / local cache
+            print(f"Warning: Could not load the quantized cross-encoder ({e}), using the FP32 model.")
+    return CrossEncoder(CROSS_ENCODER_MODEL_NAME)
+
+
+def score_passages(query, passages):
+    """Returns one relevance score per passage for query, higher is more relevant."""
+    if not passages:
+        return []
+    cross_encoder = get_cross_encoder()
+    with _predict_lock:
+        scores = cross_encoder.predict([(query, passage) for passage in passages], batch_size=PREDICT_BATCH_SIZE,
+                                       show_progress_bar=False)
+    return [float(score) for score in scores]
\ No newline at end of file
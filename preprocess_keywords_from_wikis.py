@@ -1,11 +1,23 @@
-import json
+import collections
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-from keyword_extractor import extract_keywords  # Assuming this is in your Python path or same directory
+import orjson
+import torch
+
+from build_index import get_jsonl_line_url
+from keyword_extractor import EMBEDDING_DEVICE, KEYWORD_BATCH_SIZE, extract_keywords_batch, get_kw_model  # Assuming this is in your Python path or same directory
 
 # Define file paths
 RAW_DATA_FILE = 'data/raw/bg3_wiki_data.jsonl'
 GENERATED_DATA_FILE = 'data/generated/bg3_wiki_data_keywords.jsonl'
+# Worker processes extracting keywords, each with its own KeyBERT model and an equal share of the cores.
+# KeyBERT on a GPU (KEYBERT_DEVICE, or CUDA picked automatically) defaults to one process, which already keeps
+# the GPU busy while more would each load a model copy into its memory.
+KEYBERT_ON_GPU = (EMBEDDING_DEVICE.lower() != 'cpu') if EMBEDDING_DEVICE else torch.cuda.is_available()
+KEYWORD_WORKERS = max(1, int(os.environ.get('KEYWORD_WORKERS', 0)) or (1 if KEYBERT_ON_GPU else os.cpu_count() or 1))
+MAX_BATCHES_IN_FLIGHT_PER_WORKER = 2  # Bounds how many extracted-but-unwritten batches are held in memory
 
 def load_existing_urls(filepath):
     """
@@ -17,24 +29,70 @@ def load_existing_urls(filepath):
         return existing_urls
 
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
+        with open(filepath, 'rb') as f:
             for line in f:
                 try:
-                    entry = json.loads(line.strip())
-                    if 'url' in entry:
-                        existing_urls.add(entry['url'])
-                except json.JSONDecodeError:
+                    url = get_jsonl_line_url(line)
+                    if url is not None:
+                        existing_urls.add(url)
+                except orjson.JSONDecodeError:
                     print(f"Warning: Could not parse line in existing generated file {filepath}. Skipping line.")
     except Exception as e:
         print(f"Error reading existing generated file {filepath}: {e}")
     return existing_urls
 
+def normalize_keywords(keywords_with_weights):
+    """
+    Normalizes extracted keywords to [keyword_lower, float_weight] pairs so the
+    search index can use them as-is instead of re-lowercasing and re-parsing
+    weights for every document.
+    """
+    return [[str(keyword).lower(), float(weight)] for keyword, weight in keywords_with_weights]
+
+def init_keyword_worker(num_threads):
+    """Worker process initializer: splits the cores between workers and loads KeyBERT once, before the first batch."""
+    torch.set_num_threads(num_threads)
+    get_kw_model()
+
+def extract_keyword_batch_lines(pending_entries):
+    """
+    Runs in a worker process. Extracts keywords for a batch of (url, title, text) entries with
+    one KeyBERT call and returns their JSONL lines.
+    """
+    keywords_by_entry = extract_keywords_batch([text_content for _, _, text_content in pending_entries])
+    lines = []
+    for (url, title, text_content), keywords in zip(pending_entries, keywords_by_entry):
+        # Create the new entry with the specified order
+        processed_entry = {
+            'url': url,
+            'title': title,
+            'keywords': normalize_keywords(keywords),
+            'text': text_content  # Keeping original text as requested
+        }
+        lines.append(orjson.dumps(processed_entry) + b'\n')
+    return lines
+
+def write_keyword_batch(batch_future, pending_entries, outfile):
+    """
+    Waits for a batch submitted to the worker pool and writes its lines to outfile.
+    Only the main process writes, so lines never interleave. Returns how many entries were written.
+    """
+    try:
+        lines = batch_future.result()
+    except Exception as e:
+        print(f"Error extracting keywords for a batch of {len(pending_entries)} URLs starting at "
+              f"'{pending_entries[0][0]}': {e}. Skipping batch.")
+        return 0
+    outfile.writelines(lines)
+    return len(lines)
+
 def preprocess_jsonl():
     """
     Reads the raw JSONL file, extracts keywords from the 'text' field
     if the URL is not already processed, and writes a new JSONL file
     with 'url', 'title', 'keywords', 'text'.
     Appends to the generated file if it already exists.
+    Keywords are extracted KEYWORD_BATCH_SIZE entries at a time, by KEYWORD_WORKERS processes.
     """
     os.makedirs(os.path.dirname(GENERATED_DATA_FILE), exist_ok=True)
 
@@ -47,16 +105,22 @@ def preprocess_jsonl():
     print(f"Starting preprocessing of {RAW_DATA_FILE}...")
     processed_count = 0
     skipped_count = 0
+    pending_entries = []  # (url, title, text) of unprocessed entries waiting for the next batch
+    batches_in_flight = collections.deque()  # (future, entries) of submitted batches, written in order
 
     try:
-        # Open raw file for reading, and generated file for appending ('a')
-        # If GENERATED_DATA_FILE doesn't exist, 'a' will create it.
-        with open(RAW_DATA_FILE, 'r', encoding='utf-8') as infile, \
-                open(GENERATED_DATA_FILE, 'a', encoding='utf-8') as outfile:
+        # Open raw file for reading, and generated file for appending ('ab'), both as bytes for orjson
+        # If GENERATED_DATA_FILE doesn't exist, 'ab' will create it.
+        with open(RAW_DATA_FILE, 'rb') as infile, \
+                open(GENERATED_DATA_FILE, 'ab') as outfile, \
+                ProcessPoolExecutor(max_workers=KEYWORD_WORKERS, initializer=init_keyword_worker,
+                                    initargs=(max(1, (os.cpu_count() or 1) // KEYWORD_WORKERS),),
+                                    # Forked workers can't use CUDA once KEYBERT_ON_GPU has initialized it here
+                                    mp_context=multiprocessing.get_context('spawn')) as executor:
 
             for line_number, line in enumerate(infile, 1):
                 try:
-                    entry = json.loads(line.strip())
+                    entry = orjson.loads(line)
 
                     url = entry.get('url', '')
                     title = entry.get('title', '')
@@ -72,29 +136,29 @@ def preprocess_jsonl():
                         skipped_count += 1
                         continue
 
-                    # Extract keywords from the text content with backoff
-                    # We use the same function as for user input for consistency here
-                    # but you could have a different, more aggressive one for documents
+                    # Keywords are extracted with the same KeyBERT model as for user input,
+                    # for consistency, a batch of entries at a time
                     print(f"Processing URL: {url} (Line {line_number})")
-                    keywords = extract_keywords(text_content)
-
-                    # Create the new entry with the specified order
-                    processed_entry = {
-                        'url': url,
-                        'title': title,
-                        'keywords': keywords,
-                        'text': text_content  # Keeping original text as requested
-                    }
-
-                    outfile.write(json.dumps(processed_entry) + '\n')
+                    pending_entries.append((url, title, text_content))
                     existing_urls.add(url)  # Add to our set of processed URLs for this run
-                    processed_count += 1
-
-                except json.JSONDecodeError:
+                    if len(pending_entries) >= KEYWORD_BATCH_SIZE:
+                        batches_in_flight.append((executor.submit(extract_keyword_batch_lines, pending_entries),
+                                                  pending_entries))
+                        pending_entries = []
+                        if len(batches_in_flight) >= KEYWORD_WORKERS * MAX_BATCHES_IN_FLIGHT_PER_WORKER:
+                            processed_count += write_keyword_batch(*batches_in_flight.popleft(), outfile)
+
+                except orjson.JSONDecodeError:
                     print(f"Warning: Could not parse line {line_number} in {RAW_DATA_FILE}. Skipping.")
                 except Exception as e:
                     print(
-                        f"Error processing line {line_number} for URL '{entry.get('url', 'N/A')}': {e}. Entry: {line.strip()}")
+                        f"Error processing line {line_number} for URL '{entry.get('url', 'N/A')}': {e}. Entry: {line.decode('utf-8', 'replace').strip()}")
+
+            if pending_entries:
+                batches_in_flight.append((executor.submit(extract_keyword_batch_lines, pending_entries),
+                                          pending_entries))
+            while batches_in_flight:
+                processed_count += write_keyword_batch(*batches_in_flight.popleft(), outfile)
 
     except FileNotFoundError:
         print(f"Error: Raw data file {RAW_DATA_FILE} not found.")
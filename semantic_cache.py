@@ -0,0 +1,89 @@
+# semantic_cache.py
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class SemanticCache:
+    """
+    Caches values by the embedding of the query that produced them.
+    A lookup hits when a stored, unexpired entry in the same scope has a cosine
+    similarity of at least `threshold` with the query embedding, so paraphrased
+    queries can reuse an earlier result.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_SIMILARITY_THRESHOLD, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._embeddings = None  # (N, dim) float32 matrix of unit vectors
+        self._values = []
+        self._scopes = []
+        self._timestamps = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _keep(self, mask: np.ndarray):
+        """Drops every entry whose position in mask is False. Caller holds the lock."""
+        self._embeddings = self._embeddings[mask]
+        self._values = [v for v, keep in zip(self._values, mask) if keep]
+        self._scopes = [s for s, keep in zip(self._scopes, mask) if keep]
+        self._timestamps = [t for t, keep in zip(self._timestamps, mask) if keep]
+
+    def _evict_expired(self, now: float):
+        if self._timestamps and now - self._timestamps[0] > self.ttl_seconds:
+            self._keep(np.array([now - t <= self.ttl_seconds for t in self._timestamps], dtype=bool))
+
+    def get(self, embedding, scope=None):
+        """Returns the cached value for the most similar matching query, or None on a miss."""
+        query = self._normalize(embedding)
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            if not self._values:
+                return None
+            similarities = self._embeddings @ query  # One GEMV over every cached query
+            if scope is not None:
+                in_scope = np.array([s == scope for s in self._scopes], dtype=bool)
+                similarities = np.where(in_scope, similarities, -1.0)
+            best = int(similarities.argmax())
+            if similarities[best] >= self.threshold:
+                return self._values[best]
+            return None
+
+    def set(self, embedding, value, scope=None):
+        """Stores value for the query embedding, evicting the oldest entry when full."""
+        vector = self._normalize(embedding)
+        with self._lock:
+            now = time.monotonic()
+            if self._embeddings is None:
+                self._embeddings = np.empty((0, vector.shape[0]), dtype=np.float32)
+            self._evict_expired(now)
+            if len(self._values) >= self.max_entries:
+                mask = np.ones(len(self._values), dtype=bool)
+                mask[:len(self._values) - self.max_entries + 1] = False
+                self._keep(mask)
+            self._embeddings = np.vstack([self._embeddings, vector[np.newaxis, :]])
+            self._values.append(value)
+            self._scopes.append(scope)
+            self._timestamps.append(now)
+
+    def clear(self, scope=None):
+        """Removes every entry in scope, or all entries when scope is None."""
+        with self._lock:
+            if self._embeddings is None:
+                return
+            if scope is None:
+                self._keep(np.zeros(len(self._values), dtype=bool))
+            else:
+                self._keep(np.array([s != scope for s in self._scopes], dtype=bool))
\ No newline at end of file
@@ -1,22 +1,44 @@
-import requests
+import asyncio
+import hashlib
+import aiohttp
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
-import time
 import re
-import json # For JSONL output
+import orjson # For JSONL output
 import os   # For directory creation
 
+from build_index import get_jsonl_line_url
+
 # --- Configuration ---
 HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36 MySimpleWikiBot/1.0'
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36 MySimpleWikiBot/1.0',
+    'Accept': 'text/html,application/xhtml+xml;q=0.9' # We only parse page HTML, never images/CSS/fonts
 }
-REQUEST_DELAY = 1
+CONCURRENCY = 8 # Number of crawler workers fetching pages at once
+REQUEST_DELAY = 1 # Seconds each worker waits before a request, so the wiki sees at most CONCURRENCY / REQUEST_DELAY requests per second
+REQUEST_TIMEOUT = 10
+MAX_RETRIES = 3 # Retries for connection errors, timeouts and 5xx responses
+RETRY_BACKOFF = 0.3 # Seconds; doubled on each retry
 MAX_URLS_TO_PROCESS_THIS_SESSION = 20000 # Max URLs to attempt to crawl in this run
 IGNORE_QUERY_PARAMS = True
 IGNORE_FRAGMENTS = True
-IGNORED_EXTENSIONS = ['.pdf', '.jpg', '.jpeg', '.png', '.gif', '.css', '.js', '.zip', '.xml', '.rss', '.txt', '.ico', '.svg', '.webm', '.mp4', '.mp3']
+IGNORED_EXTENSIONS = ('.pdf', '.jpg', '.jpeg', '.png', '.gif', '.css', '.js', '.zip', '.xml', '.rss', '.txt', '.ico', '.svg', '.webm', '.mp4', '.mp3') # A tuple, so str.endswith checks them all at once
+# Special MediaWiki pages, matched against the last path segment
+# You might want to customize this list based on the specific wiki structure
+WIKI_SPECIAL_PAGE_PATTERN = re.compile(r"(?:Special|File|Category|Template|Help|MediaWiki|Talk):")
+# Non-content elements stripped from the content area, as one CSS selector list
+NON_CONTENT_SELECTOR = ("nav, footer, aside, form, header, "
+                        ".noprint, .navigation-not-searchable, .mw-editsection, .toc, " # MediaWiki specific
+                        "[role=navigation], [role=search], [role=banner]")
 # --- Output Configuration ---
 OUTPUT_FILENAME = "data/raw/bg3_wiki_data.jsonl"
+# Stored with every entry so pages with the same text under different URLs (redirects, query variants) are saved once
+CONTENT_HASH_FIELD_PATTERN = re.compile(rb'"content_hash"\s*:\s*"([0-9a-f]{32})"')
+# Outbound links of every fetched page, so pages already in OUTPUT_FILENAME aren't fetched again
+# just to rediscover their links. Delete it to make the next crawl refetch those pages.
+LINKS_FILENAME = "data/raw/bg3_wiki_links.jsonl"
+OUTPUT_BUFFER_SIZE = 1 << 20 # 1 MiB write buffer for the output file
+WRITE_BATCH_SIZE = 50 # Entries written (and synced to disk) together
 
 def ensure_dir(file_path):
     """Ensures that the directory for a given file_path exists."""
@@ -30,19 +52,110 @@ def load_existing_urls(filepath):
     existing_urls = set()
     if os.path.exists(filepath):
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
+            with open(filepath, 'rb') as f:
                 for line in f:
                     try:
-                        data = json.loads(line)
-                        if 'url' in data:
-                            existing_urls.add(data['url'])
-                    except json.JSONDecodeError:
-                        print(f"Warning: Could not decode JSON line in {filepath}: {line.strip()}")
+                        url = get_jsonl_line_url(line)
+                        if url is not None:
+                            existing_urls.add(url)
+                    except orjson.JSONDecodeError:
+                        print(f"Warning: Could not decode JSON line in {filepath}: {line.decode('utf-8', 'replace').strip()}")
             print(f"Loaded {len(existing_urls)} existing URLs from {filepath}")
         except IOError as e:
             print(f"Error reading existing URLs file {filepath}: {e}")
     return existing_urls
 
+def get_content_hash(page_text):
+    """Returns the hex BLAKE2b digest identifying a page's extracted text."""
+    return hashlib.blake2b(page_text.encode('utf-8'), digest_size=16).hexdigest()
+
+def load_existing_content_hashes(filepath):
+    """
+    Loads the content hashes of the pages in an existing JSONL file, so pages serving the same
+    text under another URL aren't stored again. A file with lines written before hashes were
+    stored is migrated once by backfill_content_hashes.
+    """
+    content_hashes = set()
+    if os.path.exists(filepath):
+        try:
+            needs_backfill = False
+            with open(filepath, 'rb') as f:
+                for line in f:
+                    match = CONTENT_HASH_FIELD_PATTERN.search(line)
+                    if match:
+                        content_hashes.add(match.group(1).decode('ascii'))
+                    elif line.strip():
+                        try:
+                            needs_backfill = needs_backfill or isinstance(orjson.loads(line), dict)
+                        except orjson.JSONDecodeError:
+                            pass # Already reported by load_existing_urls
+            if needs_backfill:
+                content_hashes = backfill_content_hashes(filepath)
+            print(f"Loaded {len(content_hashes)} existing content hashes from {filepath}")
+        except IOError as e:
+            print(f"Error reading existing content hashes from {filepath}: {e}")
+    return content_hashes
+
+def backfill_content_hashes(filepath):
+    """
+    One-time migration of a JSONL file with pages saved before content hashes were stored:
+    rewrites it with a content_hash ahead of each such page's text, as crawl_website writes them,
+    so later runs read every hash without parsing lines. Returns the content hashes of its pages.
+    """
+    print(f"Adding content hashes to pages saved without one in {filepath} (one-time migration)...")
+    content_hashes = set()
+    temp_path = f"{filepath}.tmp"
+    with open(filepath, 'rb') as infile, open(temp_path, 'wb', buffering=OUTPUT_BUFFER_SIZE) as outfile:
+        for line in infile:
+            match = CONTENT_HASH_FIELD_PATTERN.search(line)
+            if match:
+                content_hashes.add(match.group(1).decode('ascii'))
+                outfile.write(line)
+                continue
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                entry = None
+            if not isinstance(entry, dict):
+                outfile.write(line) # Kept as is, load_existing_urls reports it
+                continue
+            page_text = entry.get('text')
+            content_hash = get_content_hash(page_text or '')
+            content_hashes.add(content_hash) # Like crawl_website, which also hashes empty pages
+            migrated_entry = {}
+            for key, value in entry.items():
+                if key == 'text':
+                    migrated_entry['content_hash'] = content_hash
+                if key != 'content_hash':
+                    migrated_entry[key] = value
+            migrated_entry.setdefault('content_hash', content_hash)
+            outfile.write(orjson.dumps(migrated_entry) + b'\n')
+    os.replace(temp_path, filepath) # A crash mid-rewrite leaves the original file in place
+    return content_hashes
+
+def load_cached_links(filepath):
+    """
+    Loads {url: outbound links} from an existing links JSONL file, and the set of URLs
+    recorded as duplicates of a saved page, which are never written to the output file.
+    """
+    cached_links = {}
+    duplicate_urls = set()
+    if os.path.exists(filepath):
+        try:
+            with open(filepath, 'rb') as f:
+                for line in f:
+                    try:
+                        data = orjson.loads(line)
+                        cached_links[data['url']] = data['out']
+                        if data.get('duplicate'):
+                            duplicate_urls.add(data['url'])
+                    except (orjson.JSONDecodeError, KeyError, TypeError):
+                        print(f"Warning: Could not decode links line in {filepath}: {line.decode('utf-8', 'replace').strip()}")
+            print(f"Loaded outbound links of {len(cached_links)} pages ({len(duplicate_urls)} duplicates) from {filepath}")
+        except IOError as e:
+            print(f"Error reading links file {filepath}: {e}")
+    return cached_links, duplicate_urls
+
 def is_valid_url(url, base_domain):
     """Checks if a URL is valid, within the same domain, and not an ignored type."""
     parsed_url = urlparse(url)
@@ -50,13 +163,10 @@ def is_valid_url(url, base_domain):
         return False
     if parsed_url.netloc != base_domain:
         return False
-    if any(parsed_url.path.lower().endswith(ext) for ext in IGNORED_EXTENSIONS):
+    if parsed_url.path.lower().endswith(IGNORED_EXTENSIONS):
         return False
     # Avoid crawling special MediaWiki pages if that's the target
-    # Example: "Special:", "File:", "Category:", "Template:", "Help:", "MediaWiki:"
-    # You might want to customize this list based on the specific wiki structure
-    wiki_special_prefixes = ["Special:", "File:", "Category:", "Template:", "Help:", "MediaWiki:", "Talk:"]
-    if any(parsed_url.path.split('/')[-1].startswith(prefix) for prefix in wiki_special_prefixes):
+    if WIKI_SPECIAL_PAGE_PATTERN.match(parsed_url.path.rpartition('/')[2]):
         # print(f"  Skipping MediaWiki special page: {url}")
         return False
     return True
@@ -94,135 +204,249 @@ def extract_text_content(soup):
     if content_area:
         # Remove common non-content elements that might be inside main content
         # This is heuristic and might need adjustment
-        for el_to_remove in content_area.find_all(['nav', 'footer', 'aside', 'form', 'header',
-                                                    {'class': 'noprint'}, {'class': 'navigation-not-searchable'},
-                                                    {'class': 'mw-editsection'}, {'class': 'toc'}, # MediaWiki specific
-                                                    {'role': 'navigation'}, {'role': 'search'}, {'role': 'banner'}
-                                                    ]):
+        for el_to_remove in content_area.select(NON_CONTENT_SELECTOR):
             el_to_remove.decompose()
 
         text = content_area.get_text(separator=' ', strip=True)
-        text = re.sub(r'\s+', ' ', text)  # Normalize whitespace
+        text = " ".join(text.split())  # Normalize whitespace
         return text
     return ""
 
 
-def crawl_website(start_url, output_filepath, existing_persisted_urls):
+def create_session():
+    """
+    Creates the crawler's HTTP session. Connections are pooled and kept alive,
+    so requests to the wiki reuse the same TCP+TLS connections instead of
+    handshaking for every page.
+    """
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY, limit_per_host=CONCURRENCY, keepalive_timeout=30)
+    return aiohttp.ClientSession(headers=HEADERS, connector=connector)
+
+async def fetch(session, url):
+    """
+    Fetches a URL and returns its Content-Type and raw body, raising on HTTP errors.
+    The body is None for non-HTML responses, which are never downloaded.
+    Transient failures are retried up to MAX_RETRIES times with exponential backoff.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as response:
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').lower()
+                if 'text/html' not in content_type:
+                    return content_type, None # Decided from the headers alone, skip the body
+                body = await response.read()
+                return content_type, body
+        except aiohttp.ClientResponseError as e:
+            if e.status < 500 or attempt == MAX_RETRIES:
+                raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+def parse_page(page_url, body):
+    """Parses a fetched HTML page and returns its title, text content and outbound links."""
+    soup = BeautifulSoup(body, 'lxml') # libxml2 parser; raw bytes let it handle the encoding
+
+    page_title_tag = soup.find('title')
+    page_title = page_title_tag.string.strip() if page_title_tag and page_title_tag.string else ""
+
+    page_text = extract_text_content(soup)
+
+    links = [urljoin(page_url, link_tag['href']) for link_tag in soup.find_all('a', href=True)]
+    return page_title, page_text, links
+
+def write_batch(outfile, batch):
+    """Appends a batch of JSONL lines to outfile and syncs them to disk."""
+    outfile.writelines(batch)
+    outfile.flush()
+    os.fsync(outfile.fileno()) # Bounds how much is lost if the crawl is killed
+
+async def write_entries(entries_queue, outfile, log_entries=True):
+    """
+    Consumes data entries from entries_queue and appends them to the open JSONL outfile
+    in batches of WRITE_BATCH_SIZE until a None sentinel is received.
+    Returns the number of entries written.
+    """
+    written = 0
+    batch = []
+    while True:
+        data_entry = await entries_queue.get()
+        if data_entry is None:
+            break
+        batch.append(orjson.dumps(data_entry) + b'\n')
+        if log_entries:
+            print(f"  Added to {outfile.name}: {data_entry['url']} (Title: {data_entry['title'][:50]}...)")
+        if len(batch) >= WRITE_BATCH_SIZE:
+            write_batch(outfile, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        write_batch(outfile, batch)
+        written += len(batch)
+    return written
+
+async def crawl_website(start_url, output_filepath, existing_persisted_urls, links_filepath=LINKS_FILENAME,
+                        cached_links=None, seen_content_hashes=None, duplicate_urls=None):
     """
-    Crawls a website starting from start_url, extracts title and text,
-    and appends data to a JSONL file if the URL hasn't been processed before.
+    Crawls a website starting from start_url with CONCURRENCY concurrent workers, extracts
+    title and text, and appends data to a JSONL file if the URL hasn't been processed before.
+    Pages already persisted whose outbound links are in cached_links aren't fetched, their
+    links are followed from the cache. Links of fetched pages are appended to links_filepath.
+    Pages whose text hashes to one of seen_content_hashes are duplicates and aren't written,
+    they are flagged in links_filepath and, like persisted pages, not fetched again (duplicate_urls).
     """
+    if cached_links is None:
+        cached_links = {}
+    if duplicate_urls is None:
+        duplicate_urls = set()
+    if seen_content_hashes is None:
+        seen_content_hashes = set()
     if not start_url.startswith('http://') and not start_url.startswith('https://'):
         start_url = 'http://' + start_url
 
-    try:
-        initial_response = requests.head(start_url, headers=HEADERS, timeout=10, allow_redirects=True)
-        initial_response.raise_for_status()
-        start_url = initial_response.url
-    except requests.exceptions.RequestException as e:
-        print(f"Error accessing start URL {start_url}: {e}")
-        return 0
-
-    base_domain = urlparse(start_url).netloc
-    if not base_domain:
-        print(f"Could not determine base domain from {start_url}")
-        return 0
-
-    cleaned_start_url = clean_url(start_url)
-    if not cleaned_start_url:
-        print(f"Could not clean start URL: {start_url}")
-        return 0
-
-    urls_to_visit = {cleaned_start_url}
-    visited_this_session_urls = set() # Tracks URLs processed in the current crawling session
-    new_entries_added = 0
-
-    print(f"Starting crawl on: {start_url}")
-    print(f"Base domain: {base_domain}")
-    print(f"Max URLs to process this session: {MAX_URLS_TO_PROCESS_THIS_SESSION}")
-    print(f"Output file: {output_filepath}")
-    print("-" * 30)
-
-    # Open the output file in append mode
-    try:
-        with open(output_filepath, 'a', encoding='utf-8') as outfile:
-            while urls_to_visit and len(visited_this_session_urls) < MAX_URLS_TO_PROCESS_THIS_SESSION:
-                current_url = urls_to_visit.pop()
-
-                if current_url in visited_this_session_urls:
-                    continue
-                visited_this_session_urls.add(current_url)
-
-                print(f"Processing ({len(visited_this_session_urls)}/{MAX_URLS_TO_PROCESS_THIS_SESSION}): {current_url}")
-
-                # Check if URL data already exists in the persisted file
-                # This check is crucial for the "don't add if URL already exists" requirement
-                if current_url in existing_persisted_urls:
-                    print(f"  Skipping data write (already in {output_filepath}): {current_url}")
-                    # We still want to parse it for new links if it's a page we might have missed links from before
-                    # or if it's a hub page. For simplicity in this version, we'll re-fetch if it was just skipped for writing.
-                    # A more advanced setup might avoid re-fetching if content is not needed.
+    async with create_session() as session:
+        try:
+            async with session.head(start_url, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                                    allow_redirects=True) as initial_response:
+                initial_response.raise_for_status()
+                start_url = str(initial_response.url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error accessing start URL {start_url}: {e}")
+            return 0
+
+        base_domain = urlparse(start_url).netloc
+        if not base_domain:
+            print(f"Could not determine base domain from {start_url}")
+            return 0
+
+        cleaned_start_url = clean_url(start_url)
+        if not cleaned_start_url:
+            print(f"Could not clean start URL: {start_url}")
+            return 0
+
+        urls_to_visit = asyncio.Queue()
+        urls_to_visit.put_nowait(cleaned_start_url)
+        seen_urls = {cleaned_start_url} # Every URL ever queued this session, so each is fetched once
+        entries_to_write = asyncio.Queue()
+        links_to_write = asyncio.Queue()
+        processed_count = 0
+
+        print(f"Starting crawl on: {start_url}")
+        print(f"Base domain: {base_domain}")
+        print(f"Max URLs to process this session: {MAX_URLS_TO_PROCESS_THIS_SESSION}")
+        print(f"Concurrent workers: {CONCURRENCY} (each waiting {REQUEST_DELAY}s between requests)")
+        print(f"Output file: {output_filepath}")
+        print("-" * 30)
+
+        def enqueue_links(page_links):
+            for link_url in page_links:
+                if link_url not in seen_urls:
+                    if urls_to_visit.qsize() < MAX_URLS_TO_PROCESS_THIS_SESSION * 2: # Keep queue size reasonable
+                        seen_urls.add(link_url)
+                        urls_to_visit.put_nowait(link_url)
+
+        async def crawl_worker():
+            nonlocal processed_count
+            while True:
+                current_url = await urls_to_visit.get()
                 try:
-                    time.sleep(REQUEST_DELAY)
-                    response = requests.get(current_url, headers=HEADERS, timeout=15)
-                    response.raise_for_status()
+                    # Drain the queue without fetching once the session limit is reached
+                    if processed_count >= MAX_URLS_TO_PROCESS_THIS_SESSION:
+                        continue
 
-                    content_type = response.headers.get('Content-Type', '').lower()
-                    if 'text/html' not in content_type:
-                        print(f"  Skipping non-HTML content: {content_type}")
+                    # Check if URL data already exists in the persisted file
+                    # This check is crucial for the "don't add if URL already exists" requirement
+                    if (current_url in existing_persisted_urls or current_url in duplicate_urls) and \
+                            current_url in cached_links:
+                        # Nothing to write and its links are known, so the page isn't fetched again
+                        enqueue_links(cached_links[current_url])
                         continue
+                    processed_count += 1
+
+                    print(f"Processing ({processed_count}/{MAX_URLS_TO_PROCESS_THIS_SESSION}): {current_url}")
 
-                    soup = BeautifulSoup(response.content, 'html.parser') # Use response.content for better encoding handling
+                    if current_url in existing_persisted_urls:
+                        print(f"  Skipping data write (already in {output_filepath}): {current_url}")
+                        # We still fetch it once so its links are discovered and cached.
 
-                    page_title_tag = soup.find('title')
-                    page_title = page_title_tag.string.strip() if page_title_tag and page_title_tag.string else ""
+                    await asyncio.sleep(REQUEST_DELAY) # Be polite to the wiki
+                    content_type, body = await fetch(session, current_url)
+                    if body is None:
+                        print(f"  Skipping non-HTML content: {content_type}")
+                        continue
 
-                    page_text = extract_text_content(soup)
+                    # Parsing is CPU-bound, so keep it off the event loop while other fetches are in flight
+                    page_title, page_text, links = await asyncio.to_thread(parse_page, current_url, body)
 
                     # Only add data if the URL is not already in the output file (checked by existing_persisted_urls)
+                    is_duplicate = False
                     if current_url not in existing_persisted_urls:
-                        data_entry = {
-                            "url": current_url,
-                            "title": page_title,
-                            "text": page_text
-                        }
-                        outfile.write(json.dumps(data_entry) + '\n')
-                        outfile.flush() # Ensure data is written to disk
                         existing_persisted_urls.add(current_url) # Add to in-memory set for this session
-                        new_entries_added += 1
-                        print(f"  Added to {output_filepath}: {current_url} (Title: {page_title[:50]}...)")
-                    # else:
-                        # Already printed the "Skipping data write" message above
-
-                    # Find and process links on the page
-                    for link_tag in soup.find_all('a', href=True):
-                        href = link_tag['href']
-                        absolute_url = urljoin(current_url, href)
-                        cleaned_absolute_url = clean_url(absolute_url)
-
-                        if cleaned_absolute_url and \
-                           is_valid_url(cleaned_absolute_url, base_domain) and \
-                           cleaned_absolute_url not in visited_this_session_urls and \
-                           cleaned_absolute_url not in urls_to_visit:
-                            if len(urls_to_visit) < MAX_URLS_TO_PROCESS_THIS_SESSION * 2: # Keep queue size reasonable
-                                urls_to_visit.add(cleaned_absolute_url)
-
-                except requests.exceptions.HTTPError as e:
-                    print(f"  HTTP Error for {current_url}: {e}")
-                except requests.exceptions.ConnectionError as e:
+                        content_hash = get_content_hash(page_text)
+                        if page_text and content_hash in seen_content_hashes:
+                            print(f"  Skipping data write (same text as a page already saved): {current_url}")
+                            is_duplicate = True
+                        else:
+                            seen_content_hashes.add(content_hash)
+                            await entries_to_write.put({
+                                "url": current_url,
+                                "title": page_title,
+                                "content_hash": content_hash, # Ahead of the text, so it's found without parsing the line
+                                "text": page_text
+                            })
+
+                    # Cleaned, valid and deduplicated, so the cache holds exactly what gets followed
+                    page_links = list(dict.fromkeys(
+                        cleaned_absolute_url for cleaned_absolute_url in map(clean_url, links)
+                        if cleaned_absolute_url and is_valid_url(cleaned_absolute_url, base_domain)))
+                    # Duplicates cached before they were flagged get a new, flagged record (the last record wins)
+                    if current_url not in cached_links or (is_duplicate and current_url not in duplicate_urls):
+                        cached_links[current_url] = page_links
+                        links_record = {"url": current_url, "out": page_links}
+                        if is_duplicate:
+                            duplicate_urls.add(current_url)
+                            links_record["duplicate"] = True
+                        await links_to_write.put(links_record)
+                    enqueue_links(page_links)
+
+                except aiohttp.ClientResponseError as e:
+                    print(f"  HTTP Error for {current_url}: {e.status} {e.message}")
+                except aiohttp.ClientConnectionError as e:
                     print(f"  Connection Error for {current_url}: {e}")
-                except requests.exceptions.Timeout:
+                except asyncio.TimeoutError:
                     print(f"  Timeout for {current_url}")
-                except requests.exceptions.RequestException as e:
+                except aiohttp.ClientError as e:
                     print(f"  Error fetching {current_url}: {e}")
                 except Exception as e:
                     print(f"  An unexpected error occurred while processing {current_url}: {e}")
                     import traceback
                     traceback.print_exc() # For debugging unexpected errors
+                finally:
+                    urls_to_visit.task_done()
 
-    except IOError as e:
-        print(f"FATAL: Could not open output file {output_filepath} for writing: {e}")
-        return 0 # Or raise exception
+        # Open the output files in append mode; a single writer task owns each
+        try:
+            with open(output_filepath, 'ab', buffering=OUTPUT_BUFFER_SIZE) as outfile, \
+                    open(links_filepath, 'ab', buffering=OUTPUT_BUFFER_SIZE) as links_file:
+                writer = asyncio.create_task(write_entries(entries_to_write, outfile))
+                links_writer = asyncio.create_task(write_entries(links_to_write, links_file, log_entries=False))
+                workers = [asyncio.create_task(crawl_worker()) for _ in range(CONCURRENCY)]
+
+                # Wait until every queued URL has been handled, then stop the idle workers
+                await urls_to_visit.join()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+                await entries_to_write.put(None)
+                await links_to_write.put(None)
+                new_entries_added = await writer
+                await links_writer
+        except IOError as e:
+            print(f"FATAL: Could not open output files {output_filepath} and {links_filepath} for writing: {e}")
+            return 0 # Or raise exception
 
     return new_entries_added
 
@@ -240,13 +464,19 @@ if __name__ == "__main__":
 
         # Load URLs that are already in the output file
         persisted_urls = load_existing_urls(OUTPUT_FILENAME)
+        persisted_content_hashes = load_existing_content_hashes(OUTPUT_FILENAME)
+        persisted_links, persisted_duplicate_urls = load_cached_links(LINKS_FILENAME)
 
         print("\nStarting crawler...\n")
-        newly_added_count = crawl_website(target_url, OUTPUT_FILENAME, persisted_urls)
+        newly_added_count = asyncio.run(crawl_website(target_url, OUTPUT_FILENAME, persisted_urls,
+                                                      LINKS_FILENAME, persisted_links, persisted_content_hashes,
+                                                      persisted_duplicate_urls))
 
         print("\n--- Crawl Finished ---")
         if newly_added_count > 0:
             print(f"Successfully added {newly_added_count} new entries to {OUTPUT_FILENAME}.")
         else:
             print(f"No new entries were added to {OUTPUT_FILENAME} in this session.")
-        print(f"Total unique URLs in {OUTPUT_FILENAME} (including previous): {len(persisted_urls)}")
\ No newline at end of file
+        # Duplicates are tracked like persisted URLs during the crawl but never written
+        print(f"Total unique URLs in {OUTPUT_FILENAME} (including previous): "
+              f"{len(persisted_urls - persisted_duplicate_urls)}")
\ No newline at end of file